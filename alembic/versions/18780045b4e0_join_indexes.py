@@ -0,0 +1,38 @@
+"""Join Indexes
+
+Revision ID: 18780045b4e0
+Revises: 44f1d645316e
+Create Date: 2026-10-18 14:12:40.906318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '18780045b4e0'
+down_revision = '44f1d645316e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built without locking out the crawler's writes, which can't happen
+    # inside a transaction
+    with op.get_context().autocommit_block():
+        # inventor -> patents. With `patent_id` in the key, the lookup is
+        # answered from the index alone. `inventor_patent_mapping(patent_id)`
+        # needs no index of its own, it leads the primary key
+        op.create_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), 'inventor_patent_mapping', ['inventor_key_id', 'patent_id'], unique=False, postgresql_concurrently=True)
+        # mapping -> patent columns without visiting the heap
+        op.create_index(op.f('ix_patents_patent_id_covering'), 'patents', ['patent_id'], unique=False, postgresql_include=['patent_title', 'patent_date'], postgresql_concurrently=True)
+        # Location filters, state alone or state and city
+        op.create_index(op.f('ix_inventors_location'), 'inventors', ['location_state', 'location_city'], unique=False, postgresql_concurrently=True)
+        # Date range filters, already served by `ix_patents_patent_date`
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_inventors_location'), table_name='inventors', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_patents_patent_id_covering'), table_name='patents', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), table_name='inventor_patent_mapping', postgresql_concurrently=True)
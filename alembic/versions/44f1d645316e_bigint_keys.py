@@ -0,0 +1,42 @@
+"""Bigint Keys
+
+Revision ID: 44f1d645316e
+Revises: 47db6597212e
+Create Date: 2026-10-18 13:41:09.552871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '44f1d645316e'
+down_revision = '47db6597212e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The key can't change type while the foreign key points at it
+    op.drop_constraint('inventor_patent_mapping_inventor_key_id_fkey', 'inventor_patent_mapping', type_='foreignkey')
+    op.alter_column('inventors', 'key_id', type_=sa.BIGINT(), postgresql_using='key_id::bigint', existing_nullable=False)
+    op.alter_column('inventor_patent_mapping', 'inventor_key_id', type_=sa.BIGINT(), postgresql_using='inventor_key_id::bigint', existing_nullable=False)
+    op.create_foreign_key('inventor_patent_mapping_inventor_key_id_fkey', 'inventor_patent_mapping', 'inventors', ['inventor_key_id'], ['key_id'])
+
+    # `id` was "{patent_id};{inventor_key_id}", so the pair is already unique
+    op.drop_constraint('inventor_patent_mapping_pkey', 'inventor_patent_mapping', type_='primary')
+    op.drop_column('inventor_patent_mapping', 'id')
+    op.create_primary_key('inventor_patent_mapping_pkey', 'inventor_patent_mapping', ['patent_id', 'inventor_key_id'])
+
+
+def downgrade():
+    op.drop_constraint('inventor_patent_mapping_pkey', 'inventor_patent_mapping', type_='primary')
+    op.add_column('inventor_patent_mapping', sa.Column('id', sa.VARCHAR(), nullable=True))
+    op.execute("UPDATE inventor_patent_mapping SET id = patent_id || ';' || inventor_key_id")
+    op.alter_column('inventor_patent_mapping', 'id', nullable=False)
+    op.create_primary_key('inventor_patent_mapping_pkey', 'inventor_patent_mapping', ['id'])
+
+    op.drop_constraint('inventor_patent_mapping_inventor_key_id_fkey', 'inventor_patent_mapping', type_='foreignkey')
+    op.alter_column('inventor_patent_mapping', 'inventor_key_id', type_=sa.VARCHAR(), existing_nullable=False)
+    op.alter_column('inventors', 'key_id', type_=sa.VARCHAR(), existing_nullable=False)
+    op.create_foreign_key('inventor_patent_mapping_inventor_key_id_fkey', 'inventor_patent_mapping', 'inventors', ['inventor_key_id'], ['key_id'])
@@ -0,0 +1,35 @@
+"""Quarantined Records
+
+Revision ID: 47db6597212e
+Revises: 9643c2bcd28b
+Create Date: 2026-10-18 13:02:17.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '47db6597212e'
+down_revision = '9643c2bcd28b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('quarantined_records',
+    sa.Column('id', sa.INTEGER(), nullable=False),
+    sa.Column('record_type', sa.VARCHAR(), nullable=False),
+    sa.Column('record_key', sa.VARCHAR(), nullable=True),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('error', sa.VARCHAR(), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_quarantined_records_record_key'), 'quarantined_records', ['record_key'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_quarantined_records_record_key'), table_name='quarantined_records')
+    op.drop_table('quarantined_records')
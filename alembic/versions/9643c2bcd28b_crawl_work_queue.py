@@ -0,0 +1,40 @@
+"""Crawl Work Queue
+
+Revision ID: 9643c2bcd28b
+Revises: f12ec7ac27e9
+Create Date: 2026-10-18 11:20:54.640931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9643c2bcd28b'
+down_revision = 'f12ec7ac27e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('crawl_work_queue',
+    sa.Column('id', sa.INTEGER(), nullable=False),
+    sa.Column('window_start', sa.DATE(), nullable=False),
+    sa.Column('window_end', sa.DATE(), nullable=False),
+    sa.Column('status', sa.VARCHAR(), server_default='pending', nullable=False),
+    sa.Column('worker_id', sa.VARCHAR(), nullable=True),
+    sa.Column('lease_expires_at', sa.TIMESTAMP(), nullable=True),
+    sa.Column('attempts', sa.INTEGER(), server_default='0', nullable=False),
+    sa.Column('rows_fetched', sa.INTEGER(), nullable=True),
+    sa.Column('error', sa.VARCHAR(), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('window_start', 'window_end')
+    )
+    # Workers look for claimable windows by status and lease expiry
+    op.create_index(op.f('ix_crawl_work_queue_status'), 'crawl_work_queue', ['status', 'lease_expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_crawl_work_queue_status'), table_name='crawl_work_queue')
+    op.drop_table('crawl_work_queue')
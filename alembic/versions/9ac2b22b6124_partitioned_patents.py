@@ -0,0 +1,201 @@
+"""Partitioned Patents
+
+Revision ID: 9ac2b22b6124
+Revises: 18780045b4e0
+Create Date: 2026-10-18 14:58:31.204177
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9ac2b22b6124'
+down_revision = '18780045b4e0'
+branch_labels = None
+depends_on = None
+
+# One partition per grant year, see `constants.PATENT_PARTITION_YEARS`
+PARTITION_YEARS = range(1976, 2036)
+
+
+def create_partitions():
+    for year in PARTITION_YEARS:
+        op.execute(
+            f"CREATE TABLE patents_{year} PARTITION OF patents "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        )
+    op.execute('CREATE TABLE patents_default PARTITION OF patents DEFAULT')
+
+
+def upgrade():
+    # Partitioned tables can't back a foreign key on `patent_id` alone,
+    # the mapping gets one on `(patent_id, patent_date)` below
+    op.drop_constraint('inventor_patent_mapping_patent_id_fkey', 'inventor_patent_mapping', type_='foreignkey')
+    op.drop_index(op.f('ix_patents_patent_id_covering'), table_name='patents')
+    op.drop_index(op.f('ix_patents_patent_date'), table_name='patents')
+    op.rename_table('patents', 'patents_unpartitioned')
+    op.execute('ALTER INDEX patents_pkey RENAME TO patents_unpartitioned_pkey')
+
+    op.create_table('patents',
+    sa.Column('patent_id', sa.VARCHAR(), nullable=False),
+    sa.Column('patent_date', sa.DATE(), nullable=False),
+    sa.Column('patent_number', sa.VARCHAR(), nullable=True),
+    sa.Column('patent_title', sa.VARCHAR(), nullable=False),
+    sa.Column('patent_type', sa.SMALLINT(), nullable=True),
+    sa.Column('patent_num_us_patent_citations', sa.INTEGER(), nullable=True),
+    sa.Column('created_at', sa.VARCHAR(), nullable=True),
+    sa.Column('updated_at', sa.VARCHAR(), nullable=True),
+    sa.PrimaryKeyConstraint('patent_id', 'patent_date'),
+    postgresql_partition_by='RANGE (patent_date)'
+    )
+    create_partitions()
+    op.create_index(op.f('ix_patents_patent_date'), 'patents', ['patent_date'], unique=False)
+    op.create_index(op.f('ix_patents_patent_id_covering'), 'patents', ['patent_id'], unique=False, postgresql_include=['patent_title', 'patent_date'])
+
+    # The fields that weren't stored before are filled in by the next crawl
+    op.execute(
+        '''
+        INSERT INTO patents (patent_id, patent_date, patent_title, created_at)
+        SELECT patent_id, patent_date, patent_title, created_at
+        FROM patents_unpartitioned
+        WHERE patent_date IS NOT NULL
+        '''
+    )
+    op.execute('DELETE FROM patents_unpartitioned WHERE patent_date IS NOT NULL')
+
+    # The mapping references the full key of the partitioned `patents`
+    op.add_column('inventor_patent_mapping', sa.Column('patent_date', sa.DATE(), nullable=True))
+    op.execute(
+        '''
+        UPDATE inventor_patent_mapping
+        SET patent_date = patents.patent_date
+        FROM patents
+        WHERE patents.patent_id = inventor_patent_mapping.patent_id
+        '''
+    )
+    # The mapping rows of undated patents can't reference a partition.
+    # They are set aside like the patents themselves, with a warning, and
+    # come back with the re-crawl. Plain SQL, so `--sql` works
+    op.execute(
+        '''
+        DO $$
+        DECLARE
+            unmapped BIGINT;
+        BEGIN
+            CREATE TABLE inventor_patent_mapping_undated AS
+            SELECT patent_id, inventor_key_id
+            FROM inventor_patent_mapping
+            WHERE patent_date IS NULL;
+
+            SELECT count(*) INTO unmapped FROM inventor_patent_mapping_undated;
+            IF unmapped > 0 THEN
+                DELETE FROM inventor_patent_mapping WHERE patent_date IS NULL;
+                RAISE WARNING '% mapping rows of patents without a patent_date were moved to inventor_patent_mapping_undated', unmapped;
+            ELSE
+                DROP TABLE inventor_patent_mapping_undated;
+            END IF;
+        END
+        $$
+        '''
+    )
+    op.alter_column('inventor_patent_mapping', 'patent_date', nullable=False)
+    op.drop_constraint('inventor_patent_mapping_pkey', 'inventor_patent_mapping', type_='primary')
+    op.create_primary_key('inventor_patent_mapping_pkey', 'inventor_patent_mapping', ['patent_id', 'patent_date', 'inventor_key_id'])
+    op.create_foreign_key('inventor_patent_mapping_patent_id_patent_date_fkey', 'inventor_patent_mapping', 'patents', ['patent_id', 'patent_date'], ['patent_id', 'patent_date'])
+    op.drop_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), table_name='inventor_patent_mapping')
+    op.create_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), 'inventor_patent_mapping', ['inventor_key_id', 'patent_id', 'patent_date'], unique=False)
+
+    # Stored before `patent_date` was, they need a re-crawl to be placed in
+    # a partition
+    op.execute(
+        '''
+        DO $$
+        DECLARE
+            undated BIGINT;
+        BEGIN
+            SELECT count(*) INTO undated FROM patents_unpartitioned;
+            IF undated > 0 THEN
+                ALTER TABLE patents_unpartitioned RENAME TO patents_undated;
+                ALTER INDEX patents_unpartitioned_pkey RENAME TO patents_undated_pkey;
+                RAISE WARNING '% patents without a patent_date were left in patents_undated', undated;
+            ELSE
+                DROP TABLE patents_unpartitioned;
+            END IF;
+        END
+        $$
+        '''
+    )
+
+
+def downgrade():
+    op.drop_constraint('inventor_patent_mapping_patent_id_patent_date_fkey', 'inventor_patent_mapping', type_='foreignkey')
+    op.drop_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), table_name='inventor_patent_mapping')
+    op.drop_constraint('inventor_patent_mapping_pkey', 'inventor_patent_mapping', type_='primary')
+    # Keeps the latest date's row of a re-dated patent
+    op.execute(
+        '''
+        DELETE FROM inventor_patent_mapping older
+        USING inventor_patent_mapping newer
+        WHERE older.patent_id = newer.patent_id
+            AND older.inventor_key_id = newer.inventor_key_id
+            AND older.patent_date < newer.patent_date
+        '''
+    )
+    op.drop_column('inventor_patent_mapping', 'patent_date')
+    op.create_primary_key('inventor_patent_mapping_pkey', 'inventor_patent_mapping', ['patent_id', 'inventor_key_id'])
+    op.create_index(op.f('ix_inventor_patent_mapping_inventor_key_id'), 'inventor_patent_mapping', ['inventor_key_id', 'patent_id'], unique=False)
+    op.execute(
+        '''
+        DO $$
+        BEGIN
+            IF to_regclass('inventor_patent_mapping_undated') IS NOT NULL THEN
+                INSERT INTO inventor_patent_mapping (patent_id, inventor_key_id)
+                SELECT patent_id, inventor_key_id
+                FROM inventor_patent_mapping_undated
+                ON CONFLICT (patent_id, inventor_key_id) DO NOTHING;
+                DROP TABLE inventor_patent_mapping_undated;
+            END IF;
+        END
+        $$
+        '''
+    )
+
+    op.create_table('patents_unpartitioned',
+    sa.Column('patent_id', sa.VARCHAR(), nullable=False),
+    sa.Column('patent_title', sa.VARCHAR(), nullable=False),
+    sa.Column('created_at', sa.VARCHAR(), nullable=True),
+    sa.Column('patent_date', sa.DATE(), nullable=True),
+    sa.PrimaryKeyConstraint('patent_id', name='patents_unpartitioned_pkey')
+    )
+    # A patent re-dated by the API is in two partitions, the latest wins
+    op.execute(
+        '''
+        INSERT INTO patents_unpartitioned (patent_id, patent_title, created_at, patent_date)
+        SELECT DISTINCT ON (patent_id) patent_id, patent_title, created_at, patent_date
+        FROM patents
+        ORDER BY patent_id, patent_date DESC
+        '''
+    )
+    op.execute(
+        '''
+        DO $$
+        BEGIN
+            IF to_regclass('patents_undated') IS NOT NULL THEN
+                INSERT INTO patents_unpartitioned (patent_id, patent_title, created_at, patent_date)
+                SELECT patent_id, patent_title, created_at, patent_date
+                FROM patents_undated
+                ON CONFLICT (patent_id) DO NOTHING;
+                DROP TABLE patents_undated;
+            END IF;
+        END
+        $$
+        '''
+    )
+    # Dropping the parent drops every partition
+    op.drop_table('patents')
+    op.rename_table('patents_unpartitioned', 'patents')
+    op.execute('ALTER INDEX patents_unpartitioned_pkey RENAME TO patents_pkey')
+    op.create_index(op.f('ix_patents_patent_date'), 'patents', ['patent_date'], unique=False)
+    op.create_index(op.f('ix_patents_patent_id_covering'), 'patents', ['patent_id'], unique=False, postgresql_include=['patent_title', 'patent_date'])
+    op.create_foreign_key('inventor_patent_mapping_patent_id_fkey', 'inventor_patent_mapping', 'patents', ['patent_id'], ['patent_id'])
@@ -0,0 +1,24 @@
+"""Crawl Work Queue Retry After
+
+Revision ID: ae0c21d535a2
+Revises: 9ac2b22b6124
+Create Date: 2026-10-18 16:12:07.518342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ae0c21d535a2'
+down_revision = '9ac2b22b6124'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('crawl_work_queue', sa.Column('retry_after', sa.TIMESTAMP(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('crawl_work_queue', 'retry_after')
@@ -0,0 +1,34 @@
+"""Crawl Manifest
+
+Revision ID: ede291f56b16
+Revises: f134d8e20489
+Create Date: 2026-10-18 09:12:41.532107
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ede291f56b16'
+down_revision = 'f134d8e20489'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('crawl_manifest',
+    sa.Column('window_key', sa.VARCHAR(), nullable=False),
+    sa.Column('page', sa.INTEGER(), nullable=False),
+    sa.Column('status', sa.VARCHAR(), nullable=False),
+    sa.Column('total_patent_count', sa.INTEGER(), nullable=True),
+    sa.Column('row_count', sa.INTEGER(), nullable=True),
+    sa.Column('response_hash', sa.VARCHAR(), nullable=True),
+    sa.Column('error', sa.VARCHAR(), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('window_key', 'page')
+    )
+
+
+def downgrade():
+    op.drop_table('crawl_manifest')
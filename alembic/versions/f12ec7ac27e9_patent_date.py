@@ -0,0 +1,27 @@
+"""Patent Date
+
+Revision ID: f12ec7ac27e9
+Revises: ede291f56b16
+Create Date: 2026-10-18 10:03:27.118452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f12ec7ac27e9'
+down_revision = 'ede291f56b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('patents', sa.Column('patent_date', sa.DATE(), nullable=True))
+    # Makes `max(patent_date)` (the delta sync high-water mark) an index lookup
+    op.create_index(op.f('ix_patents_patent_date'), 'patents', ['patent_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_patents_patent_date'), table_name='patents')
+    op.drop_column('patents', 'patent_date')
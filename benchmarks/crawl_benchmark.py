@@ -0,0 +1,202 @@
+"""
+Measures the crawl throughput of the sync (`get_api`) and async
+(`PatentsViewClient.get_api`) paths against the local mock server
+
+    python -m benchmarks.crawl_benchmark --years 1980 --latency 0.1 --concurrency 8
+
+Reports requests/s, rows/s and p50/p99 request latency for each path.
+The mock server runs in a thread of the benchmark process by default,
+pass `--url` to drive one started with `python -m benchmarks.mock_server`
+in its own process instead
+"""
+
+
+import math
+import time
+import asyncio
+import argparse
+
+from typing import Callable, List
+
+from patents_view_api.api_utils import (
+    PatentsViewClient,
+    get_api,
+    prepare_options_query,
+)
+from patents_view_api.constants import PER_PAGE, f_parameter_str
+from patents_view_api.crawler import count_pages
+from patents_view_api.rate_limit import RetryPolicy
+from patents_view_api.windows import month_windows
+
+from .mock_server import MockConfig, MockServerThread
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+    return ordered[index]
+
+
+class BenchmarkResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.rows = 0
+        self.elapsed_seconds = 0.0
+
+    def record(self, latency: float, rows: int):
+        self.latencies.append(latency)
+        self.rows += rows
+
+    def report(self) -> str:
+        requests = len(self.latencies)
+        elapsed = self.elapsed_seconds or float('inf')
+        return (
+            f'{self.name:<8} '
+            f'requests={requests:<6} '
+            f'requests/s={requests / elapsed:<8.1f} '
+            f'rows/s={self.rows / elapsed:<10.0f} '
+            f'p50={percentile(self.latencies, 50) * 1000:.0f}ms '
+            f'p99={percentile(self.latencies, 99) * 1000:.0f}ms'
+        )
+
+
+def timed(result: BenchmarkResult, fetch: Callable[[], dict]) -> dict:
+    started_at = time.perf_counter()
+    response_dict = fetch()
+    result.record(
+        time.perf_counter() - started_at,
+        len(response_dict.get('patents') or []),
+    )
+    return response_dict
+
+
+def run_sync(url: str, years, per_page: int) -> BenchmarkResult:
+    result = BenchmarkResult('sync')
+    retry_policy = RetryPolicy(base_delay=0.05)
+    started_at = time.perf_counter()
+
+    for window in month_windows(years):
+        page_num = 1
+        page_count = 1
+        while page_num <= page_count:
+            response_dict = timed(result, lambda: get_api(
+                url=url,
+                date_query_str=window.to_query(),
+                f_parameter_str=f_parameter_str,
+                options_query_str=prepare_options_query(
+                    page_num=page_num,
+                    per_page=per_page,
+                ),
+                retry_policy=retry_policy,
+            ))
+            page_count = count_pages(
+                response_dict.get('total_patent_count') or 0,
+                per_page=per_page,
+            )
+            page_num += 1
+
+    result.elapsed_seconds = time.perf_counter() - started_at
+    return result
+
+
+async def run_async(
+    url: str,
+    years,
+    per_page: int,
+    concurrency: int,
+) -> BenchmarkResult:
+    result = BenchmarkResult('async')
+    started_at = time.perf_counter()
+
+    async with PatentsViewClient(
+        max_concurrency=concurrency,
+        limit_per_host=concurrency,
+        retry_policy=RetryPolicy(base_delay=0.05),
+    ) as client:
+        async def fetch(window, page_num):
+            request_started_at = time.perf_counter()
+            response_dict = await client.get_api(
+                url=url,
+                date_query_str=window.to_query(),
+                f_parameter_str=f_parameter_str,
+                options_query_str=prepare_options_query(
+                    page_num=page_num,
+                    per_page=per_page,
+                ),
+            )
+            result.record(
+                time.perf_counter() - request_started_at,
+                len(response_dict.get('patents') or []),
+            )
+            return response_dict
+
+        async def crawl(window):
+            first_page = await fetch(window, 1)
+            page_count = count_pages(
+                first_page.get('total_patent_count') or 0,
+                per_page=per_page,
+            )
+            await asyncio.gather(*[
+                fetch(window, page_num)
+                for page_num in range(2, page_count + 1)
+            ])
+
+        await asyncio.gather(*[
+            crawl(window) for window in month_windows(years)
+        ])
+
+    result.elapsed_seconds = time.perf_counter() - started_at
+    return result
+
+
+def run_benchmarks(url: str, args: argparse.Namespace):
+    if 'sync' in args.paths:
+        print(run_sync(url, args.years, args.per_page).report())
+    if 'async' in args.paths:
+        print(asyncio.run(run_async(
+            url,
+            args.years,
+            args.per_page,
+            args.concurrency,
+        )).report())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--years', type=int, nargs='+', default=[1980])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--per-page', type=int, default=PER_PAGE)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--patents-per-week', type=int, default=1500)
+    parser.add_argument(
+        '--paths',
+        nargs='+',
+        choices=['sync', 'async'],
+        default=['sync', 'async'],
+    )
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=0.1,
+        patents_per_week=args.patents_per_week,
+    )
+    if args.url:
+        run_benchmarks(args.url, args)
+    else:
+        with MockServerThread(config) as url:
+            run_benchmarks(url, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+A local stand-in for `https://api.patentsview.org/patents/query`
+
+It implements the `q`/`f`/`o` contract used by `prepare_date_query` and
+`prepare_options_query` on top of a deterministic synthetic patent
+generator, so the crawler can be load tested without the public API
+
+    python -m benchmarks.mock_server --port 8080 --latency 0.2 --error-rate 0.01
+
+Then point the crawler at `http://localhost:8080/patents/query`
+"""
+
+
+import json
+import random
+import asyncio
+import argparse
+import threading
+
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+from patents_view_api.cache import find_patent_dates
+
+MAX_PER_PAGE = 10000
+
+PATENT_FIELDS = [
+    "patent_id",
+    "patent_number",
+    "patent_title",
+    "patent_date",
+    "patent_type",
+    "patent_num_us_patent_citations",
+]
+INVENTOR_FIELDS = [
+    "inventor_first_name",
+    "inventor_last_name",
+    "inventor_longitude",
+    "inventor_latitude",
+    "inventor_city",
+    "inventor_state",
+]
+TITLE_WORDS = [
+    'Space', 'enclosing', 'member', 'Method', 'apparatus', 'for',
+    'controlling', 'fluid', 'valve', 'Semiconductor', 'device', 'optical',
+    'signal', 'processing', 'system', 'composition', 'vehicle', 'seat',
+]
+FIRST_NAMES = ['Marcus L.', 'Ada', 'Grace', 'Alan', 'Katherine', 'Hedy']
+LAST_NAMES = ['Ridgeway, Jr.', 'Lovelace', 'Hopper', 'Turing', 'Johnson']
+CITIES = [
+    ('Troy', 'TX', -97.3002, 31.2004),
+    ('Boston', 'MA', -71.0589, 42.3601),
+    ('San Jose', 'CA', -121.8863, 37.3382),
+    ('Tokyo', None, 139.6917, 35.6895),
+]
+
+
+class MockConfig:
+    """
+    - `latency` seconds are added to every response, +/- `latency_jitter`
+    - `error_rate` of the requests answer 500
+    - `throttle_rate` of the requests answer 429 with `Retry-After`
+    - `patents_per_week` is the average size of a weekly grant batch
+    - `max_per_page` clamps the `per_page` option like the real API
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 1.0,
+        patents_per_week: int = 1500,
+        max_per_page: int = MAX_PER_PAGE,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.patents_per_week = patents_per_week
+        self.max_per_page = max_per_page
+        self.seed = seed
+
+
+class SyntheticPatents:
+    """
+    Deterministic patents: the same date always grants the same patents
+    """
+
+    def __init__(self, patents_per_week: int, seed: int = 0):
+        self.patents_per_week = patents_per_week
+        self.seed = seed
+
+    def count_on(self, day: date) -> int:
+        # Patents are granted on Tuesdays
+        if day.weekday() != 1:
+            return 0
+        rng = random.Random(f'{self.seed}:count:{day.toordinal()}')
+        return max(0, int(rng.gauss(self.patents_per_week,
+                                    self.patents_per_week * 0.1)))
+
+    def patent(self, day: date, index: int, fields: List[str]) -> dict:
+        rng = random.Random(f'{self.seed}:patent:{day.toordinal()}:{index}')
+        patent_id = f'{day.toordinal() - 720000:06d}{index:04d}'
+        values = {
+            "patent_id": patent_id,
+            "patent_number": patent_id,
+            "patent_title": ' '.join(rng.sample(TITLE_WORDS, 4)),
+            "patent_date": day.isoformat(),
+            "patent_type": rng.choice(['utility'] * 9 + ['design']),
+            "patent_num_us_patent_citations": str(rng.randint(0, 40)),
+        }
+        patent = {
+            field: values[field] for field in PATENT_FIELDS
+            if field in fields
+        }
+
+        inventor_fields = [
+            field for field in INVENTOR_FIELDS if field in fields
+        ]
+        if inventor_fields:
+            patent['inventors'] = []
+            for _ in range(rng.randint(1, 3)):
+                # A small pool so prolific inventors show up repeatedly
+                key_id = rng.randint(1, 50000)
+                inventor_rng = random.Random(f'{self.seed}:inventor:{key_id}')
+                city, state, longitude, latitude = inventor_rng.choice(CITIES)
+                inventor_values = {
+                    "inventor_first_name": inventor_rng.choice(FIRST_NAMES),
+                    "inventor_last_name": inventor_rng.choice(LAST_NAMES),
+                    "inventor_longitude": str(longitude),
+                    "inventor_latitude": str(latitude),
+                    "inventor_city": city,
+                    "inventor_state": state,
+                }
+                inventor = {
+                    field: inventor_values[field] for field in inventor_fields
+                }
+                inventor["inventor_key_id"] = str(key_id)
+                patent['inventors'].append(inventor)
+
+        return patent
+
+    def query(
+        self,
+        start: date,
+        end: date,
+        fields: List[str],
+        page: int,
+        per_page: int,
+    ) -> Tuple[List[dict], int]:
+        """
+        Returns one page of the patents granted between `start` and `end`
+        and the total count, only generating the patents of that page
+        """
+        offset = (page - 1) * per_page
+        patents = []
+        total_count = 0
+        day = start
+        while day <= end:
+            count = self.count_on(day)
+            first = max(0, offset - total_count)
+            last = min(count, offset + per_page - total_count)
+            for index in range(first, last):
+                patents.append(self.patent(day, index, fields))
+            total_count += count
+            day += timedelta(days=1)
+        return patents, total_count
+
+
+def parse_window(q: Optional[str]) -> Tuple[date, date]:
+    patent_dates = [
+        date.fromisoformat(patent_date)
+        for patent_date in find_patent_dates(json.loads(q))
+    ]
+    if not patent_dates:
+        raise ValueError('`q` needs a `patent_date` range')
+    return min(patent_dates), max(patent_dates)
+
+
+def create_app(config: MockConfig) -> web.Application:
+    generator = SyntheticPatents(
+        patents_per_week=config.patents_per_week,
+        seed=config.seed,
+    )
+    rng = random.Random(config.seed)
+    app = web.Application()
+
+    async def patents_query(request: web.Request) -> web.Response:
+        if config.latency or config.latency_jitter:
+            await asyncio.sleep(max(0.0, rng.uniform(
+                config.latency - config.latency_jitter,
+                config.latency + config.latency_jitter,
+            )))
+
+        roll = rng.random()
+        if roll < config.throttle_rate:
+            return web.Response(
+                status=429,
+                headers={'Retry-After': str(config.retry_after)},
+            )
+        if roll < config.throttle_rate + config.error_rate:
+            return web.Response(status=500, text='Synthetic error')
+
+        try:
+            start, end = parse_window(request.query.get('q'))
+            fields = json.loads(request.query.get('f', '[]'))
+            options = json.loads(request.query.get('o', '{}'))
+        except (TypeError, ValueError) as error:
+            return web.Response(status=400, text=str(error))
+
+        page = int(options.get('page', 1))
+        per_page = min(int(options.get('per_page', 25)), config.max_per_page)
+        patents, total_count = generator.query(
+            start=start,
+            end=end,
+            fields=fields,
+            page=page,
+            per_page=per_page,
+        )
+
+        response = web.json_response({
+            'patents': patents or None,
+            'count': len(patents),
+            'total_patent_count': total_count,
+        })
+        response.enable_compression()
+        return response
+
+    app.router.add_get('/patents/query', patents_query)
+    return app
+
+
+class MockServerThread:
+    """
+    Runs the mock server on its own event loop in a background thread
+
+        with MockServerThread(MockConfig(latency=0.1)) as url:
+            get_api(url=url, ...)
+    """
+
+    def __init__(
+        self,
+        config: MockConfig,
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ):
+        self.config = config
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.runner = None
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}/patents/query'
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.runner = web.AppRunner(create_app(self.config))
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        # Port 0 lets the OS pick a free port
+        self.port = self.runner.addresses[0][1]
+        self.started.set()
+
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def __enter__(self) -> str:
+        self.thread.start()
+        self.started.wait()
+        return self.url
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--patents-per-week', type=int, default=1500)
+    parser.add_argument('--max-per-page', type=int, default=MAX_PER_PAGE)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        patents_per_week=args.patents_per_week,
+        max_per_page=args.max_per_page,
+        seed=args.seed,
+    )
+    print(f'Mock PatentsView API on http://{args.host}:{args.port}/patents/query')
+    web.run_app(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
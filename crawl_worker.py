@@ -0,0 +1,26 @@
+import sys
+import asyncio
+
+from patents_view_api.api_utils import PatentsViewClient
+from patents_view_api.windows import month_windows
+from patents_view_api.work_queue import (
+    enqueue_windows,
+    get_worker_progress,
+    run_worker,
+)
+
+
+async def main():
+    # Every worker enqueues the same windows, the duplicates are ignored
+    enqueue_windows(month_windows(range(1980, 2022)))
+
+    async with PatentsViewClient() as client:
+        await run_worker(
+            client=client,
+            worker_id=sys.argv[1] if len(sys.argv) > 1 else None,
+        )
+
+    for progress in get_worker_progress():
+        print(progress)
+
+asyncio.run(main())
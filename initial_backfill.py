@@ -0,0 +1,27 @@
+import asyncio
+
+from patents_view_api import database
+from patents_view_api.api_utils import PatentsViewClient
+from patents_view_api.backfill import backfill_mode
+from patents_view_api.pipeline import CrawlPipeline
+from patents_view_api.windows import month_windows
+
+
+async def main():
+    async with PatentsViewClient(max_concurrency=8) as client:
+        # `COPY` and one set-based merge per page, the fastest loader into
+        # tables without indexes to maintain
+        pipeline = CrawlPipeline(
+            client=client,
+            store=database.store_patents,
+            writers=4,
+        )
+        stats = await pipeline.run(
+            window.to_query() for window in month_windows(range(1976, 2022))
+        )
+    print(stats)
+
+# Only for empty tables: the indexes and foreign keys are rebuilt once at
+# the end instead of being maintained by every insert
+with backfill_mode():
+    asyncio.run(main())
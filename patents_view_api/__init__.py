@@ -1,9 +1,10 @@
-from .api_utils import get_patents
+from .api_utils import get_patents, PatentsViewClient
 
 
 print('I will prepate `patents_view_api')
 
 
 __all__ = [
-    'get_patents'
+    'get_patents',
+    'PatentsViewClient',
 ]
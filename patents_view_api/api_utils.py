@@ -1,10 +1,35 @@
 import json
+import time
+import calendar
+import asyncio
+import itertools
 import requests
 import nest_asyncio
 
-from typing import Union
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Union
 
-from aiohttp import ClientSession
+from aiohttp import (
+    ClientConnectionError,
+    ClientPayloadError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+from .cache import CacheWriter, ResponseCache
+from .decoding import PageDecoder, decode_json
+from .constants import FIELD_PROFILES, PER_PAGE, REQUEST_TIMEOUT
+from .rate_limit import RetryPolicy, TokenBucket, parse_retry_after
+from .transfer import ACCEPT_ENCODING, Decompressor, TransferStats
+from .streaming import (
+    STREAM_BATCH_SIZE,
+    STREAM_CHUNK_SIZE,
+    PatentStreamParser,
+    aiter_patent_batches,
+    iter_patent_batches,
+)
 
 print('I will prepare `api_utils.py`')
 
@@ -13,6 +38,24 @@ print('I will prepare `api_utils.py`')
 # because Jupyter notebook already starts an event loop
 nest_asyncio.apply()
 
+# Retried by `PatentsViewClient`, along with 429/5xx responses.
+# `ClientPayloadError` is a body that broke off, e.g. the server closed
+# the connection halfway
+RETRIED_ERRORS = (
+    ClientConnectionError,
+    ClientPayloadError,
+    asyncio.TimeoutError,
+)
+# The same for the sync functions. `ChunkedEncodingError` and
+# `ContentDecodingError` are a body that broke off or was cut short while
+# being read, a read timeout in the body comes as `ConnectionError`
+RETRIED_SYNC_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+)
+
 
 def get_patents(url: str) -> dict:
     print('Getting patents...')
@@ -20,7 +63,13 @@ def get_patents(url: str) -> dict:
     return response.json()
 
 
-async def async_get_patents(url: str) -> dict:
+async def async_get_patents(
+    url: str,
+    client: Optional['PatentsViewClient'] = None,
+) -> dict:
+    if client is not None:
+        return await client.get_patents(url)
+
     print('Getting patents...')
     http_session = ClientSession()
 
@@ -35,8 +84,12 @@ async def async_get_patents(url: str) -> dict:
 def prepare_date_query(
     year: Union[str, int],
     month: Union[str, int],
-    days: Union[str, int],
+    days: Optional[Union[str, int]] = None,
 ) -> str:
+    # The last day of the month, taking leap years into account
+    if days is None:
+        days = calendar.monthrange(int(year), int(month))[1]
+
     #  if type(month) == int:
     if isinstance(month, int):
         month = str(month).zfill(2)
@@ -68,55 +121,683 @@ def prepare_date_query(
     return json.dumps(date_query)
 
 
-def prepare_options_query(page_num: int) -> str:
+def prepare_options_query(page_num: int, per_page: int = PER_PAGE) -> str:
     options_query = {
         'page': page_num,
-        'per_page': 10000,
+        'per_page': per_page,
     }
     return json.dumps(options_query)
 
 
+def prepare_fields_query(profile: str) -> str:
+    """
+    The `f` parameter of a field profile, e.g. `prepare_fields_query('minimal')`
+    """
+    try:
+        return json.dumps(FIELD_PROFILES[profile])
+    except KeyError:
+        raise ValueError(
+            f'Unknown field profile {profile!r}, '
+            f'expected one of {sorted(FIELD_PROFILES)}'
+        ) from None
+
+
+def prepare_api_params(
+    date_query_str: str,
+    f_parameter_str: str,
+    options_query_str: str,
+) -> dict:
+    return {
+        'q': date_query_str,
+        'f': f_parameter_str,
+        'o': options_query_str,
+    }
+
+
+def sleep_before_retry(
+    retry_policy: RetryPolicy,
+    rate_limiter: Optional[TokenBucket],
+    window_key: str,
+    attempt: int,
+    status: Optional[int],
+    retry_after: Optional[float],
+):
+    delay = retry_policy.next_delay(
+        window_key=window_key,
+        attempt=attempt,
+        status=status,
+        retry_after=retry_after,
+    )
+    if rate_limiter is not None and retry_after is not None:
+        # Slow down every other request of the crawl too
+        rate_limiter.pause(retry_after)
+    print(f'Retrying in {delay:.1f}s (status {status})')
+    time.sleep(delay)
+
+
+def send_request(
+    url: str,
+    params: dict,
+    window_key: str,
+    rate_limiter: Optional[TokenBucket] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    stream: bool = False,
+    timeout: Tuple[float, float] = REQUEST_TIMEOUT,
+) -> requests.Response:
+    """
+    Sends a GET request, retrying 429/5xx responses, connection errors and
+    timeouts according to `retry_policy`, and returns the first successful
+    response. `timeout` is `(connect, read)` seconds, see `REQUEST_TIMEOUT`
+
+    Without `stream` the body is read here, so one that breaks off is
+    retried too. With `stream=True` the body is not read yet, the caller
+    has to close the response (and retry a broken body, see `stream_api`)
+    """
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+
+    for attempt in itertools.count():
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        status = None
+        retry_after = None
+        try:
+            response = requests.get(
+                url=url,
+                params=params,
+                headers={'Accept-Encoding': ACCEPT_ENCODING},
+                stream=stream,
+                timeout=timeout,
+            )
+        except RETRIED_SYNC_ERRORS as error:
+            print(f'Request failed: {error!r}')
+        else:
+            status = response.status_code
+            if status < 400:
+                return response
+
+            response.close()
+            if not retry_policy.should_retry(status):
+                response.raise_for_status()
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After')
+            )
+
+        sleep_before_retry(
+            retry_policy,
+            rate_limiter,
+            window_key=window_key,
+            attempt=attempt,
+            status=status,
+            retry_after=retry_after,
+        )
+
+
+def record_transfer(
+    transfer_stats: Optional[TransferStats],
+    response: requests.Response,
+    body_bytes: int,
+):
+    if transfer_stats is None:
+        return
+    transfer_stats.record(
+        url=response.url,
+        encoding=response.headers.get('Content-Encoding'),
+        # urllib3 counts the bytes read from the socket, before decoding
+        wire_bytes=response.raw.tell(),
+        body_bytes=body_bytes,
+    )
+
+
 def get_api(
     url: str,
     date_query_str: str,
     f_parameter_str: str,
     options_query_str: str,
+    rate_limiter: Optional[TokenBucket] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    cache: Optional[ResponseCache] = None,
+    transfer_stats: Optional[TransferStats] = None,
 ) -> dict:
-    response = requests.get(
+    params = prepare_api_params(
+        date_query_str=date_query_str,
+        f_parameter_str=f_parameter_str,
+        options_query_str=options_query_str,
+    )
+    if cache is not None:
+        body = cache.get(url, params)
+        if body is not None:
+            return decode_json(body)
+
+    response = send_request(
         url=url,
-        params={
-            'q': date_query_str,
-            'f': f_parameter_str,
-            'o': options_query_str,
-        }
+        params=params,
+        window_key=date_query_str,
+        rate_limiter=rate_limiter,
+        retry_policy=retry_policy,
     )
+    record_transfer(transfer_stats, response, len(response.content))
+    if cache is not None:
+        cache.set(url, params, response.content)
+
     # store response object as python dicitonary
-    response_dict = response.json()
+    response_dict = decode_json(response.content)
     # variable to store the count of patents per repsonse,
     # i.e. count of patent applications per month
     return response_dict
 
 
+def stream_api(
+    url: str,
+    date_query_str: str,
+    f_parameter_str: str,
+    options_query_str: str,
+    batch_size: int = STREAM_BATCH_SIZE,
+    parser: Optional[PatentStreamParser] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    cache: Optional[ResponseCache] = None,
+    transfer_stats: Optional[TransferStats] = None,
+) -> Iterator[List[dict]]:
+    """
+    Like `get_api`, but yields the page as batches of at most `batch_size`
+    patents while it is being downloaded, instead of building one dict of
+    10,000 patents
+
+    Pass a `parser` to read `count`/`total_patent_count` from
+    `parser.metadata` once the batches are exhausted
+
+    A body that breaks off is requested again, and the patents that were
+    already yielded are skipped, so every patent is yielded once
+    """
+    params = prepare_api_params(
+        date_query_str=date_query_str,
+        f_parameter_str=f_parameter_str,
+        options_query_str=options_query_str,
+    )
+    if cache is not None:
+        body = cache.get(url, params)
+        if body is not None:
+            yield from iter_patent_batches(
+                [body],
+                batch_size=batch_size,
+                parser=parser,
+            )
+            return
+
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if parser is None:
+        parser = PatentStreamParser()
+
+    yielded_count = 0
+    for attempt in itertools.count():
+        response = send_request(
+            url=url,
+            params=params,
+            window_key=date_query_str,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            stream=True,
+        )
+        body_bytes = 0
+        skip_count = yielded_count
+        parser.reset()
+
+        def count_chunks(chunks):
+            nonlocal body_bytes
+            for chunk in chunks:
+                body_bytes += len(chunk)
+                yield chunk
+
+        try:
+            with response:
+                chunks = count_chunks(
+                    response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                )
+                if cache is not None:
+                    chunks = cache.iter_cached(url, params, chunks)
+
+                for batch in iter_patent_batches(
+                    chunks,
+                    batch_size=batch_size,
+                    parser=parser,
+                ):
+                    # Already yielded before the body broke off
+                    if skip_count >= len(batch):
+                        skip_count -= len(batch)
+                        continue
+                    batch = batch[skip_count:]
+                    skip_count = 0
+                    yielded_count += len(batch)
+                    yield batch
+                record_transfer(transfer_stats, response, body_bytes)
+            return
+        except RETRIED_SYNC_ERRORS as error:
+            print(f'Reading the body failed: {error!r}')
+            sleep_before_retry(
+                retry_policy,
+                rate_limiter,
+                window_key=date_query_str,
+                attempt=attempt,
+                status=None,
+                retry_after=None,
+            )
+
+
 async def async_get_api(
     url: str,
     date_query_str: str,
     f_parameter_str: str,
     options_query_str: str,
+    client: Optional['PatentsViewClient'] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+    retry_policy: Optional[RetryPolicy] = None,
 ) -> dict:
+    # Reuse the pooled session when the caller already has one open
+    if client is not None:
+        return await client.get_api(
+            url=url,
+            date_query_str=date_query_str,
+            f_parameter_str=f_parameter_str,
+            options_query_str=options_query_str,
+        )
 
-    http_session = ClientSession()
-    async with http_session.get(
+    async with PatentsViewClient(
+        max_concurrency=1,
+        rate_limiter=rate_limiter,
+        retry_policy=retry_policy,
+    ) as client:
+        return await client.get_api(
             url=url,
-            params={
-                'q': date_query_str,
-                'f': f_parameter_str,
-                'o': options_query_str,
-            }
-    ) as response:
+            date_query_str=date_query_str,
+            f_parameter_str=f_parameter_str,
+            options_query_str=options_query_str,
+        )
+
+
+class PatentsViewClient:
+    """
+    A long-lived HTTP client that keeps one `ClientSession` open for a
+    whole crawl, so the TCP+TLS handshake is paid once instead of once per
+    month/page
+
+        async with PatentsViewClient(max_concurrency=8) as client:
+            response_dict = await client.get_api(
+                url=...,
+                date_query_str=...,
+                f_parameter_str=...,
+                options_query_str=...,
+            )
+
+    `max_concurrency` caps the requests in flight at the same time, even
+    when the caller schedules every month with `asyncio.ensure_future`.
+    `rate_limiter` caps the requests per second and `retry_policy` decides
+    how 429/5xx responses are retried. With a `cache`, responses are served
+    from disk when possible
+
+    Responses are requested gzip (or brotli, when installed) compressed and
+    decoded by the client itself, so `transfer_stats` can record the bytes
+    that actually crossed the wire for every request. Bodies are decoded by
+    `decoder`, which moves big pages off the event loop
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        limit_per_host: int = 8,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+        request_timeout: float = 300,
+        rate_limiter: Optional[TokenBucket] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        cache: Optional[ResponseCache] = None,
+        transfer_stats: Optional[TransferStats] = None,
+        decoder: Optional[PageDecoder] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.request_timeout = request_timeout
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.transfer_stats = transfer_stats or TransferStats()
+        self.decoder = decoder or PageDecoder()
+
+        self.http_session = None
+        self.semaphore = None
+
+    async def __aenter__(self) -> 'PatentsViewClient':
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def open(self):
+        if self.http_session is not None:
+            return
+
+        connector = TCPConnector(
+            # Never open more sockets than requests we allow in flight
+            limit=self.max_concurrency,
+            limit_per_host=self.limit_per_host,
+            # Keep idle connections around between pages of the crawl
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self.http_session = ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=self.request_timeout),
+            headers={'Accept-Encoding': ACCEPT_ENCODING},
+            # See `read_body`, we decode ourselves to count wire bytes
+            auto_decompress=False,
+        )
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.http_session is None:
+            return
+
+        await self.http_session.close()
+        self.http_session = None
+        self.semaphore = None
+
+    def _require_session(self) -> ClientSession:
+        if self.http_session is None:
+            raise RuntimeError(
+                'PatentsViewClient is not open, '
+                'use `async with PatentsViewClient() as client:`'
+            )
+        return self.http_session
+
+    async def get_patents(self, url: str) -> dict:
+        print('Getting patents...')
+        http_session = self._require_session()
+
+        async with self.semaphore:
+            async with http_session.get(url) as response:
+                response_json = await self.decoder.decode(
+                    await self.read_body(response)
+                )
+
+        return response_json
+
+    async def iter_body(
+        self,
+        response: ClientResponse,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ) -> AsyncIterator[bytes]:
+        """
+        Yields the decoded body of `response` chunk by chunk and records its
+        size on the wire in `self.transfer_stats`
+        """
+        encoding = response.headers.get('Content-Encoding')
+        decompressor = Decompressor(encoding)
+        wire_bytes = 0
+        body_bytes = 0
+
+        async for chunk in response.content.iter_chunked(chunk_size):
+            wire_bytes += len(chunk)
+            data = decompressor.decompress(chunk)
+            if data:
+                body_bytes += len(data)
+                yield data
+
+        data = decompressor.flush()
+        if data:
+            body_bytes += len(data)
+            yield data
+
+        self.transfer_stats.record(
+            url=str(response.url),
+            encoding=encoding,
+            wire_bytes=wire_bytes,
+            body_bytes=body_bytes,
+        )
+
+    async def read_body(self, response: ClientResponse) -> bytes:
+        return b''.join([chunk async for chunk in self.iter_body(response)])
+
+    async def wait_for_retry(
+        self,
+        window_key: str,
+        attempt: int,
+        status: Optional[int],
+        retry_after: Optional[float],
+    ):
+        delay = self.retry_policy.next_delay(
+            window_key=window_key,
+            attempt=attempt,
+            status=status,
+            retry_after=retry_after,
+        )
+        if self.rate_limiter is not None and retry_after is not None:
+            # Slow down every other request of the crawl too
+            self.rate_limiter.pause(retry_after)
+        print(f'Retrying in {delay:.1f}s (status {status})')
+        # Sleep outside the semaphore so other requests can go ahead
+        await asyncio.sleep(delay)
+
+    async def fetch_body(
+        self,
+        url: str,
+        params: dict,
+        window_key: str,
+    ) -> bytes:
+        """
+        Sends a GET request and reads the whole body, retrying 429/5xx
+        responses, connection errors and bodies cut short (timeouts,
+        disconnects, truncated payloads) according to `self.retry_policy`
+        """
+        http_session = self._require_session()
+
+        for attempt in itertools.count():
+            if self.rate_limiter is not None:
+                await self.rate_limiter.async_acquire()
+
+            status = None
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    async with http_session.get(
+                            url=url,
+                            params=params,
+                    ) as response:
+                        status = response.status
+                        if status < 400:
+                            # Read in the loop, so a body that breaks off
+                            # is fetched again
+                            return await self.read_body(response)
+
+                        if not self.retry_policy.should_retry(status):
+                            response.raise_for_status()
+                        retry_after = parse_retry_after(
+                            response.headers.get('Retry-After')
+                        )
+            except RETRIED_ERRORS as error:
+                print(f'Request failed: {error!r}')
+                status = None
+
+            await self.wait_for_retry(
+                window_key=window_key,
+                attempt=attempt,
+                status=status,
+                retry_after=retry_after,
+            )
+
+    async def get_body(
+        self,
+        url: str,
+        params: dict,
+        window_key: str,
+    ) -> bytes:
+        """
+        `fetch_body` through `self.cache`: a cached body is returned without
+        a request and a fetched one is cached. In offline mode a body that
+        isn't cached raises `CacheMiss`
+        """
+        if self.cache is not None:
+            # Reading from disk would block every other request
+            body = await asyncio.to_thread(self.cache.get, url, params)
+            if body is not None:
+                return body
+
+        body = await self.fetch_body(
+            url=url,
+            params=params,
+            window_key=window_key,
+        )
+
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.set, url, params, body)
+        return body
+
+    @asynccontextmanager
+    async def request(
+        self,
+        url: str,
+        params: dict,
+        window_key: str,
+    ) -> AsyncIterator[ClientResponse]:
+        """
+        Sends a GET request, retrying 429/5xx responses and connection
+        errors according to `self.retry_policy`, and yields the first
+        successful response while holding one of the concurrency slots
+
+            async with client.request(url, params, window_key) as response:
+                async for chunk in client.iter_body(response):
+                    ...
+
+        For streaming only: errors while the body is read can't be retried
+        once the response is handed out. Use `fetch_body` to get a whole
+        body with retries
+        """
+        http_session = self._require_session()
+
+        for attempt in itertools.count():
+            if self.rate_limiter is not None:
+                await self.rate_limiter.async_acquire()
+
+            status = None
+            retry_after = None
+            succeeded = False
+            try:
+                async with self.semaphore:
+                    async with http_session.get(
+                            url=url,
+                            params=params,
+                    ) as response:
+                        status = response.status
+                        if status < 400:
+                            succeeded = True
+                            yield response
+                            return
+
+                        if not self.retry_policy.should_retry(status):
+                            response.raise_for_status()
+                        retry_after = parse_retry_after(
+                            response.headers.get('Retry-After')
+                        )
+            except RETRIED_ERRORS as error:
+                # Errors while the caller reads the body are not retried
+                # here, the response was already handed out
+                if succeeded:
+                    raise
+                print(f'Request failed: {error!r}')
+
+            await self.wait_for_retry(
+                window_key=window_key,
+                attempt=attempt,
+                status=status,
+                retry_after=retry_after,
+            )
+
+    async def get_api(
+        self,
+        url: str,
+        date_query_str: str,
+        f_parameter_str: str,
+        options_query_str: str,
+    ) -> dict:
+        params = prepare_api_params(
+            date_query_str=date_query_str,
+            f_parameter_str=f_parameter_str,
+            options_query_str=options_query_str,
+        )
+        body = await self.get_body(
+            url=url,
+            params=params,
+            window_key=date_query_str,
+        )
         # store response object as python dicitonary
-        response_dict = await response.json()
-        # variable to store the count of patents per repsonse,
-        # i.e. count of patent applications per month
-    await http_session.close()
+        return await self.decoder.decode(body)
 
-    return response_dict
+    async def stream_api(
+        self,
+        url: str,
+        date_query_str: str,
+        f_parameter_str: str,
+        options_query_str: str,
+        batch_size: int = STREAM_BATCH_SIZE,
+        parser: Optional[PatentStreamParser] = None,
+    ) -> AsyncIterator[List[dict]]:
+        """
+        The `async for` version of `stream_api`
+        """
+        params = prepare_api_params(
+            date_query_str=date_query_str,
+            f_parameter_str=f_parameter_str,
+            options_query_str=options_query_str,
+        )
+        if self.cache is not None:
+            body = await asyncio.to_thread(self.cache.get, url, params)
+            if body is not None:
+                for batch in iter_patent_batches(
+                    [body],
+                    batch_size=batch_size,
+                    parser=parser,
+                ):
+                    yield batch
+                return
+
+        async with self.request(
+            url=url,
+            params=params,
+            window_key=date_query_str,
+        ) as response:
+            chunks = self.iter_body(response)
+            if self.cache is None:
+                async for batch in aiter_patent_batches(
+                    chunks,
+                    batch_size=batch_size,
+                    parser=parser,
+                ):
+                    yield batch
+                return
+
+            cache_writer = self.cache.writer(url, params)
+            try:
+                async for batch in aiter_patent_batches(
+                    write_chunks(chunks, cache_writer),
+                    batch_size=batch_size,
+                    parser=parser,
+                ):
+                    yield batch
+            except BaseException:
+                cache_writer.abort()
+                raise
+            cache_writer.commit()
+
+
+async def write_chunks(
+    chunks: AsyncIterator[bytes],
+    cache_writer: CacheWriter,
+) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        cache_writer.write(chunk)
+        yield chunk
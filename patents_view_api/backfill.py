@@ -0,0 +1,268 @@
+"""
+An initial backfill mode, for loading the whole history into empty tables
+
+    with backfill_mode():
+        ...  # crawl and store 1976 to today
+
+On the way in, the foreign keys and secondary indexes of the tables are
+dropped (their definitions are kept) and, optionally, the tables are made
+UNLOGGED, so every insert only maintains the primary keys. On the way out
+the indexes are rebuilt in parallel on several connections, the foreign
+keys are re-added and validated and the tables are ANALYZEd
+
+The primary keys and unique indexes stay, the upserts need them for
+`ON CONFLICT`
+"""
+
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Sequence
+
+from .database import pooled_connection
+
+BACKFILL_TABLES = ['patents', 'inventors', 'inventor_patent_mapping']
+# Connections rebuilding indexes at the same time
+BACKFILL_INDEX_BUILDERS = 4
+BACKFILL_MAINTENANCE_WORK_MEM = '1GB'
+
+
+class BackfillError(Exception):
+    """
+    Raised when backfill mode would touch tables that already have data
+    """
+
+
+class IndexDefinition(NamedTuple):
+    name: str
+    definition: str
+
+
+class ForeignKeyDefinition(NamedTuple):
+    name: str
+    table: str
+    definition: str
+
+
+def fetch_all(sql: str, params: tuple = ()) -> List[tuple]:
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+
+def execute(*statements: str):
+    """
+    Runs `statements` in one transaction on a pooled connection
+    """
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        for statement in statements:
+            cur.execute(statement)
+        conn.commit()
+
+
+def check_tables_empty(tables: Sequence[str]):
+    non_empty = [
+        table for table in tables
+        if fetch_all(f'SELECT EXISTS (SELECT 1 FROM {table})')[0][0]
+    ]
+    if non_empty:
+        raise BackfillError(
+            f'Refusing to run a backfill into non-empty tables {non_empty}, '
+            'it drops their indexes and foreign keys. Use the regular '
+            'loaders to add to existing data'
+        )
+
+
+def get_secondary_indexes(tables: Sequence[str]) -> List[IndexDefinition]:
+    # Indexes of the partitions come with the partitioned index of
+    # `patents`, only the parent tables' are listed
+    rows = fetch_all(
+        '''
+        SELECT index_class.relname, pg_get_indexdef(index_class.oid),
+            index_class.relkind
+        FROM pg_index
+        JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+        JOIN pg_class table_class ON table_class.oid = pg_index.indrelid
+        WHERE table_class.relname = ANY(%s)
+            AND NOT pg_index.indisprimary
+            AND NOT pg_index.indisunique
+        ''',
+        (list(tables),),
+    )
+    return [
+        IndexDefinition(name, parent_index_definition(definition, relkind))
+        for name, definition, relkind in rows
+    ]
+
+
+def parent_index_definition(definition: str, relkind: str) -> str:
+    """
+    `pg_get_indexdef` of a partitioned index (relkind `I`) says
+    `ON ONLY patents`, which creates an invalid index with none on the
+    partitions. Without `ONLY` it's built on every partition
+    """
+    if relkind == 'I':
+        return definition.replace(' ON ONLY ', ' ON ', 1)
+    return definition
+
+
+def get_foreign_keys(tables: Sequence[str]) -> List[ForeignKeyDefinition]:
+    rows = fetch_all(
+        '''
+        SELECT constraint_.conname, table_class.relname,
+            pg_get_constraintdef(constraint_.oid)
+        FROM pg_constraint constraint_
+        JOIN pg_class table_class ON table_class.oid = constraint_.conrelid
+        JOIN pg_class referenced ON referenced.oid = constraint_.confrelid
+        WHERE constraint_.contype = 'f'
+            AND constraint_.conparentid = 0
+            AND (
+                table_class.relname = ANY(%s)
+                OR referenced.relname = ANY(%s)
+            )
+        ''',
+        (list(tables), list(tables)),
+    )
+    return [ForeignKeyDefinition(*row) for row in rows]
+
+
+def get_storage_tables(tables: Sequence[str]) -> List[str]:
+    """
+    The tables that hold rows: the partitions of a partitioned table, the
+    table itself otherwise
+    """
+    rows = fetch_all(
+        '''
+        SELECT table_class.relname
+        FROM pg_class table_class
+        LEFT JOIN pg_inherits ON pg_inherits.inhrelid = table_class.oid
+        LEFT JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        WHERE table_class.relkind = 'r'
+            AND (
+                table_class.relname = ANY(%s)
+                OR parent.relname = ANY(%s)
+            )
+        ''',
+        (list(tables), list(tables)),
+    )
+    return [row[0] for row in rows]
+
+
+def set_logged(tables: Sequence[str], logged: bool):
+    mode = 'LOGGED' if logged else 'UNLOGGED'
+    execute(*[f'ALTER TABLE {table} SET {mode}' for table in tables])
+
+
+def build_index(
+    index: IndexDefinition,
+    maintenance_work_mem: str,
+) -> float:
+    started_at = time.monotonic()
+    execute(
+        f"SET maintenance_work_mem = '{maintenance_work_mem}'",
+        index.definition,
+    )
+    seconds = time.monotonic() - started_at
+    print(f'Rebuilt {index.name} in {seconds:.1f}s')
+    return seconds
+
+
+def restore_indexes(
+    indexes: Sequence[IndexDefinition],
+    builders: int,
+    maintenance_work_mem: str,
+):
+    """
+    Builds the indexes on `builders` connections at once (Postgres also
+    parallelises each build with `max_parallel_maintenance_workers`)
+    """
+    with ThreadPoolExecutor(
+        max_workers=builders,
+        thread_name_prefix='backfill-index',
+    ) as executor:
+        futures = [
+            executor.submit(build_index, index, maintenance_work_mem)
+            for index in indexes
+        ]
+        for future in futures:
+            future.result()
+
+
+def restore_foreign_keys(foreign_keys: Sequence[ForeignKeyDefinition]):
+    # Added NOT VALID first, so the check doesn't hold the heavier lock
+    # that `ADD CONSTRAINT` takes
+    for foreign_key in foreign_keys:
+        execute(
+            f'ALTER TABLE {foreign_key.table} '
+            f'ADD CONSTRAINT {foreign_key.name} '
+            f'{foreign_key.definition} NOT VALID'
+        )
+        started_at = time.monotonic()
+        execute(
+            f'ALTER TABLE {foreign_key.table} '
+            f'VALIDATE CONSTRAINT {foreign_key.name}'
+        )
+        print(
+            f'Validated {foreign_key.name} in '
+            f'{time.monotonic() - started_at:.1f}s'
+        )
+
+
+@contextmanager
+def backfill_mode(
+    tables: Sequence[str] = BACKFILL_TABLES,
+    unlogged: bool = False,
+    index_builders: int = BACKFILL_INDEX_BUILDERS,
+    maintenance_work_mem: str = BACKFILL_MAINTENANCE_WORK_MEM,
+) -> Iterator[None]:
+    """
+    Defers index maintenance and foreign key checks of `tables` until the
+    `with` block is done
+
+    - Refuses to start if any of `tables` has rows
+    - `unlogged=True` also skips the WAL while loading. An UNLOGGED table is
+        emptied if Postgres crashes, and turning it back to LOGGED rewrites
+        it once, so it only pays off for a load that can be redone
+    - Everything is restored even if the block raises
+    """
+    check_tables_empty(tables)
+    indexes = get_secondary_indexes(tables)
+    foreign_keys = get_foreign_keys(tables)
+    storage_tables = get_storage_tables(tables) if unlogged else []
+
+    print(
+        f'Backfill mode: dropping {len(indexes)} indexes and '
+        f'{len(foreign_keys)} foreign keys'
+    )
+    execute(
+        *[
+            f'ALTER TABLE {foreign_key.table} '
+            f'DROP CONSTRAINT {foreign_key.name}'
+            for foreign_key in foreign_keys
+        ],
+        *[f'DROP INDEX {index.name}' for index in indexes],
+    )
+    # Only once the foreign keys are gone, a logged table can't reference
+    # an unlogged one
+    if storage_tables:
+        set_logged(storage_tables, logged=False)
+
+    try:
+        yield
+    finally:
+        started_at = time.monotonic()
+        if storage_tables:
+            set_logged(storage_tables, logged=True)
+        restore_indexes(indexes, index_builders, maintenance_work_mem)
+        restore_foreign_keys(foreign_keys)
+        execute(*[f'ANALYZE {table}' for table in tables])
+        print(
+            f'Backfill mode: restored the tables in '
+            f'{time.monotonic() - started_at:.1f}s'
+        )
@@ -0,0 +1,303 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from datetime import date, timedelta
+from typing import Iterable, Iterator, List, Optional
+
+# Where responses are cached unless told otherwise
+CACHE_DIRECTORY = '.patents_view_cache'
+# 5 GB of compressed responses
+CACHE_MAX_BYTES = 5 * 1024 ** 3
+# How long responses of recent windows are kept
+CACHE_TTL_SECONDS = 24 * 60 * 60
+# Windows that ended longer ago than this never change anymore
+CACHE_IMMUTABLE_AFTER_DAYS = 365
+
+
+class CacheMiss(Exception):
+    """
+    Raised in offline mode when a request is not in the cache
+    """
+
+
+def normalize_param(value: str) -> str:
+    """
+    `{"page": 1, "per_page": 10000}` and `{"per_page":10000,"page":1}` are
+    the same query, so they have to be the same cache key
+    """
+    try:
+        return json.dumps(
+            json.loads(value),
+            sort_keys=True,
+            separators=(',', ':'),
+        )
+    except (TypeError, ValueError):
+        return value
+
+
+def find_patent_dates(query) -> List[str]:
+    """
+    Collects every `patent_date` value of a `q` parameter
+    """
+    if isinstance(query, dict):
+        dates = []
+        for key, value in query.items():
+            if key == 'patent_date' and isinstance(value, str):
+                dates.append(value)
+            else:
+                dates.extend(find_patent_dates(value))
+        return dates
+    if isinstance(query, list):
+        return [
+            patent_date
+            for value in query
+            for patent_date in find_patent_dates(value)
+        ]
+    return []
+
+
+class ResponseCache:
+    """
+    A content-addressed cache of compressed API responses on local disk
+
+    - Keys are the sha256 of the normalised `(url, q, f, o)`
+    - Bodies are stored gzip compressed, one file per response
+    - Responses of windows that ended more than `immutable_after_days` ago
+        never expire, the others expire after `ttl_seconds`
+    - When the cache grows over `max_bytes` the least recently used
+        responses are removed
+    - With `offline=True` nothing is downloaded and a miss raises
+        `CacheMiss`
+    """
+
+    def __init__(
+        self,
+        directory: str = CACHE_DIRECTORY,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ttl_seconds: float = CACHE_TTL_SECONDS,
+        immutable_after_days: int = CACHE_IMMUTABLE_AFTER_DAYS,
+        offline: bool = False,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.immutable_after_days = immutable_after_days
+        self.offline = offline
+
+        self.lock = threading.Lock()
+        # Lazily computed by `_current_bytes`
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(url: str, params: dict) -> str:
+        normalized = json.dumps([
+            url,
+            normalize_param(params.get('q')),
+            normalize_param(params.get('f')),
+            normalize_param(params.get('o')),
+        ])
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        # Spread the files over 256 folders to keep directories small
+        return os.path.join(self.directory, key[:2], f'{key}.json.gz')
+
+    def ttl(self, params: dict) -> Optional[float]:
+        """
+        Returns how many seconds a response may be kept, `None` meaning
+        forever
+        """
+        try:
+            patent_dates = find_patent_dates(json.loads(params.get('q')))
+            window_end = max(date.fromisoformat(d) for d in patent_dates)
+        except (TypeError, ValueError):
+            # Not a date window we understand, treat it as recent
+            return self.ttl_seconds
+
+        immutable_before = (
+            date.today() - timedelta(days=self.immutable_after_days)
+        )
+        if window_end < immutable_before:
+            return None
+        return self.ttl_seconds
+
+    def get(self, url: str, params: dict) -> Optional[bytes]:
+        path = self.path(self.make_key(url, params))
+
+        try:
+            with gzip.open(path, 'rb') as cache_file:
+                header = json.loads(cache_file.readline())
+                body = cache_file.read()
+        except (FileNotFoundError, OSError, ValueError):
+            body = None
+        else:
+            expires_at = header.get('expires_at')
+            if expires_at is not None and expires_at < time.time():
+                self._remove(path)
+                body = None
+            else:
+                # The modification time is the "last used" time for LRU
+                os.utime(path)
+
+        with self.lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if body is None and self.offline:
+            raise CacheMiss(f'{url} {params} is not cached')
+        return body
+
+    def set(self, url: str, params: dict, body: bytes):
+        writer = self.writer(url, params)
+        try:
+            writer.write(body)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def writer(self, url: str, params: dict) -> 'CacheWriter':
+        """
+        Returns a writer that compresses a response while it is streamed
+        and only adds it to the cache once `commit` is called
+        """
+        ttl = self.ttl(params)
+        header = {
+            'url': url,
+            'params': params,
+            'stored_at': time.time(),
+            'expires_at': None if ttl is None else time.time() + ttl,
+        }
+        return CacheWriter(
+            cache=self,
+            path=self.path(self.make_key(url, params)),
+            header=header,
+        )
+
+    def iter_cached(
+        self,
+        url: str,
+        params: dict,
+        chunks: Iterable[bytes],
+    ) -> Iterator[bytes]:
+        """
+        Passes `chunks` through while writing them to the cache
+        """
+        writer = self.writer(url, params)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes': self._current_bytes(),
+            }
+
+    def _list_files(self) -> List[os.DirEntry]:
+        files = []
+        for folder in os.scandir(self.directory):
+            if folder.is_dir():
+                files.extend(
+                    entry for entry in os.scandir(folder.path)
+                    if entry.name.endswith('.json.gz')
+                )
+        return files
+
+    def _current_bytes(self) -> int:
+        # Called with `self.lock` held
+        if self.total_bytes is None:
+            self.total_bytes = sum(
+                entry.stat().st_size for entry in self._list_files()
+            )
+        return self.total_bytes
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes -= size
+
+    def _added(self, size: int):
+        with self.lock:
+            self.total_bytes = self._current_bytes() + size
+            if self.total_bytes <= self.max_bytes:
+                return
+
+            # Evict down to 90% of the cap so we don't evict on every write
+            target = self.max_bytes * 0.9
+            files = sorted(
+                self._list_files(),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            for entry in files:
+                if self.total_bytes <= target:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                self.total_bytes -= size
+
+
+class CacheWriter:
+    """
+    Writes one response to a temporary file and moves it into the cache
+    on `commit`, so a half downloaded response is never served
+    """
+
+    def __init__(self, cache: ResponseCache, path: str, header: dict):
+        self.cache = cache
+        self.path = path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, self.temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            suffix='.tmp',
+        )
+        self.raw_file = os.fdopen(file_descriptor, 'wb')
+        self.file = gzip.open(self.raw_file, 'wb')
+        self.file.write(json.dumps(header).encode('utf-8') + b'\n')
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.raw_file.close()
+        size = os.path.getsize(self.temporary_path)
+        if os.path.exists(self.path):
+            self.cache._remove(self.path)
+        os.replace(self.temporary_path, self.path)
+        self.cache._added(size)
+
+    def abort(self):
+        self.file.close()
+        self.raw_file.close()
+        try:
+            os.remove(self.temporary_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,194 @@
+"""
+Stores pages of patents a few transactions at a time, setting aside the
+records that can't be stored instead of losing the whole page
+
+    store = CommitPolicy(rows_per_transaction=1000)
+    store(patents)
+
+Each sub-batch is written inside a savepoint. When it fails, the savepoint
+is rolled back and the sub-batch is bisected until the bad patents are
+found. Those go to `quarantined_records` with their error, everything else
+is committed
+"""
+
+
+import threading
+
+from typing import List, Optional
+
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from .database import initialize_sqlalchemy_connection
+from .models import QuarantinedRecord
+from .queries import (
+    STORE_CHUNK_SIZE,
+    InvalidRecordError,
+    chunked,
+    store_patents,
+)
+
+# Patents per transaction (each with its inventors and mapping rows)
+ROWS_PER_TRANSACTION = 1000
+# Errors that mean a record is bad, not that the database is unavailable:
+# constraint violations, values Postgres rejects and malformed API records.
+# Anything else (lost connections, timeouts, deadlocks, bugs) is raised,
+# bisecting it would quarantine good records
+ISOLATED_ERRORS = (IntegrityError, DataError, InvalidRecordError)
+
+
+class CommitStats:
+    def __init__(self):
+        self.transactions = 0
+        self.rows = 0
+        self.quarantined = 0
+        self.savepoints = 0
+        self.lock = threading.Lock()
+
+    def add(self, **amounts: int):
+        with self.lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def __repr__(self) -> str:
+        return (
+            f'CommitStats(transactions={self.transactions}, '
+            f'rows={self.rows}, quarantined={self.quarantined}, '
+            f'savepoints={self.savepoints})'
+        )
+
+
+class CommitPolicy:
+    """
+    - `rows_per_transaction` patents are committed together
+    - With `isolate_errors`, a failing sub-batch is bisected and only the
+        patents that fail on their own are quarantined. Without it the
+        error is raised like `queries.store_patents` does
+
+    Deadlocks and serialization failures are not the record's fault, they
+    are raised so the caller can retry (see `writers.run_transaction`)
+
+    Callable like `queries.store_patents`, so it can be handed to
+    `CrawlPipeline` or `run_worker` as `store`. Given a `session` it is a
+    session store (see `stores.py`): every sub-batch still gets its
+    savepoint, but nothing is committed, that's left to the caller
+    """
+    is_session_store = True
+
+    def __init__(
+        self,
+        rows_per_transaction: int = ROWS_PER_TRANSACTION,
+        isolate_errors: bool = True,
+        chunk_size: int = STORE_CHUNK_SIZE,
+    ):
+        if rows_per_transaction < 1:
+            raise ValueError('`rows_per_transaction` must be at least 1')
+        self.rows_per_transaction = rows_per_transaction
+        self.isolate_errors = isolate_errors
+        self.chunk_size = chunk_size
+        self.stats = CommitStats()
+
+    def try_store(
+        self,
+        patents: List[dict],
+        session: Session,
+    ) -> Optional[BaseException]:
+        """
+        Stores `patents` in a savepoint, returns the error (and rolls the
+        savepoint back) if they can't be stored
+        """
+        self.stats.add(savepoints=1)
+        savepoint = session.begin_nested()
+        try:
+            store_patents(
+                patents,
+                session=session,
+                chunk_size=self.chunk_size,
+            )
+            savepoint.commit()
+            return None
+        except ISOLATED_ERRORS as error:
+            savepoint.rollback()
+            return error
+
+    def bisect(
+        self,
+        patents: List[dict],
+        error: BaseException,
+        session: Session,
+    ):
+        """
+        Stores what it can of a sub-batch that failed with `error`
+        """
+        if len(patents) == 1:
+            self.quarantine(patents[0], error, session)
+            return
+
+        middle = len(patents) // 2
+        for half in (patents[:middle], patents[middle:]):
+            half_error = self.try_store(half, session)
+            if half_error is not None:
+                self.bisect(half, half_error, session)
+
+    def quarantine(
+        self,
+        patent: dict,
+        error: BaseException,
+        session: Session,
+    ):
+        self.stats.add(quarantined=1)
+        # The driver's message is more useful than SQLAlchemy's wrapper
+        message = str(getattr(error, 'orig', None) or error)
+        session.add(QuarantinedRecord(
+            record_type='patent',
+            record_key=str(patent.get('patent_id')),
+            payload=patent,
+            error=f'{type(error).__name__}: {message}',
+        ))
+        session.flush()
+        print(f'Quarantined patent {patent.get("patent_id")}: {message}')
+
+    def store(
+        self,
+        patents: List[dict],
+        session: Session,
+        commit: bool = True,
+    ):
+        for transaction_patents in chunked(
+            patents,
+            self.rows_per_transaction,
+        ):
+            if self.isolate_errors:
+                error = self.try_store(transaction_patents, session)
+                if error is not None:
+                    self.bisect(transaction_patents, error, session)
+            else:
+                store_patents(
+                    transaction_patents,
+                    session=session,
+                    chunk_size=self.chunk_size,
+                )
+            if commit:
+                session.commit()
+            self.stats.add(
+                transactions=int(commit),
+                rows=len(transaction_patents),
+            )
+
+    def __call__(
+        self,
+        patents: List[dict],
+        commit: bool = True,
+        session: Optional[Session] = None,
+    ):
+        # Commits every `rows_per_transaction` patents of its own
+        # sessions, `commit` is only accepted for compatibility with
+        # `queries.store_patents`
+        if session is not None:
+            return self.store(patents, session=session, commit=False)
+        return store_with_policy(patents, policy=self)
+
+
+@initialize_sqlalchemy_connection
+def store_with_policy(patents: List[dict], policy: CommitPolicy, session):
+    policy.store(patents, session=session)
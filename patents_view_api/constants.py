@@ -1,6 +1,16 @@
 import json
 
+PATENTS_QUERY_URL = 'https://api.patentsview.org/patents/query'
+# Maximum number of patents the API returns in a single page
+PER_PAGE = 10000
+# `(connect, read)` seconds of the sync `requests` calls. The read timeout
+# is per socket read, not for the whole body, and leaves the API time to
+# assemble a full page
+REQUEST_TIMEOUT = (10, 120)
+
 # array of month days, index being months
+# NOTE: February is always 28 days here, use `calendar.monthrange` when
+# leap years matter
 months = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
 
 F_PARAMETER = [
@@ -18,3 +28,109 @@ F_PARAMETER = [
     "inventor_state"
 ]
 f_parameter_str = json.dumps(F_PARAMETER)
+
+# Named sets of fields to request per crawl, so loaders that only need
+# ids and titles don't download inventor geodata for every row. The crawl
+# entry points take one as `profile`
+MINIMAL_FIELDS = [
+    "patent_id",
+    "patent_title",
+    "patent_date",
+]
+INVENTOR_FIELDS = MINIMAL_FIELDS + [
+    "inventor_first_name",
+    "inventor_last_name",
+    "inventor_city",
+    "inventor_state",
+]
+FIELD_PROFILES = {
+    'minimal': MINIMAL_FIELDS,
+    'inventors': INVENTOR_FIELDS,
+    'full': F_PARAMETER,
+}
+
+# The storage columns each profile populates, by table
+PROFILE_COLUMNS = {
+    'minimal': {
+        'patents': ['patent_id', 'patent_title', 'patent_date'],
+    },
+    'inventors': {
+        'patents': ['patent_id', 'patent_title', 'patent_date'],
+        'inventors': [
+            'key_id',
+            'first_name',
+            'last_name',
+            'location_city',
+            'location_state',
+        ],
+        'inventor_patent_mapping': [
+            'patent_id',
+            'patent_date',
+            'inventor_key_id',
+        ],
+    },
+    'full': {
+        'patents': [
+            'patent_id',
+            'patent_number',
+            'patent_title',
+            'patent_date',
+            'patent_type',
+            'patent_num_us_patent_citations',
+        ],
+        'inventors': [
+            'key_id',
+            'first_name',
+            'last_name',
+            'location_city',
+            'location_state',
+            'location_longitude',
+            'location_latitude',
+        ],
+        'inventor_patent_mapping': [
+            'patent_id',
+            'patent_date',
+            'inventor_key_id',
+        ],
+    },
+}
+
+
+
+def optional_columns(table: str) -> list:
+    """
+    The columns of `table` that some of the profiles populating it don't
+    fetch, in `full` profile order
+    """
+    profiles = [
+        columns[table]
+        for columns in PROFILE_COLUMNS.values()
+        if table in columns
+    ]
+    return [
+        column
+        for column in PROFILE_COLUMNS['full'][table]
+        if not all(column in columns for columns in profiles)
+    ]
+
+
+# Missing from the rows of a lighter profile, and sometimes sent empty.
+# Missing and empty values are NULL in the rows to store, and both store
+# paths (`queries.upsert_rows`, `database.merge_staging`) keep the stored
+# value instead of overwriting it with a NULL
+PATENT_OPTIONAL_COLUMNS = optional_columns('patents')
+INVENTOR_OPTIONAL_COLUMNS = optional_columns('inventors')
+
+# `patents.patent_type` is stored as a SMALLINT code
+PATENT_TYPES = {
+    'utility': 1,
+    'design': 2,
+    'plant': 3,
+    'reissue': 4,
+    'defensive publication': 5,
+    'statutory invention registration': 6,
+}
+# `patents` is partitioned by year of `patent_date`. Years outside of these
+# land in `patents_default`
+PATENT_PARTITION_YEARS = range(1976, 2036)
+
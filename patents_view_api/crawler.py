@@ -0,0 +1,159 @@
+import math
+import asyncio
+
+from typing import AsyncIterator, Iterable, List, Optional, Tuple, Union
+
+from .api_utils import (
+    PatentsViewClient,
+    prepare_date_query,
+    prepare_fields_query,
+    prepare_options_query,
+)
+from .constants import PATENTS_QUERY_URL, PER_PAGE, f_parameter_str
+from .windows import DateWindow, month_windows, plan_windows
+
+
+def count_pages(total_patent_count: int, per_page: int = PER_PAGE) -> int:
+    # A window with no patents still costs the first request
+    return max(1, math.ceil(total_patent_count / per_page))
+
+
+async def crawl_window(
+    client: PatentsViewClient,
+    date_query_str: str,
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    profile: Optional[str] = None,
+) -> List[dict]:
+    """
+    Fetches every page of a single date window
+
+    The first page tells us `total_patent_count`, the remaining pages are
+    then requested at the same time. The concurrency budget is owned by
+    `client`, so many windows can be crawled at once without opening more
+    sockets than `client.max_concurrency`
+
+    `profile` names a `FIELD_PROFILES` entry to request instead of
+    `f_parameter_str`
+    """
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    first_page = await client.get_api(
+        url=url,
+        date_query_str=date_query_str,
+        f_parameter_str=f_parameter_str,
+        options_query_str=prepare_options_query(
+            page_num=1,
+            per_page=per_page,
+        ),
+    )
+    total_patent_count = first_page.get('total_patent_count') or 0
+    page_count = count_pages(total_patent_count, per_page=per_page)
+
+    remaining_pages = await asyncio.gather(*[
+        client.get_api(
+            url=url,
+            date_query_str=date_query_str,
+            f_parameter_str=f_parameter_str,
+            options_query_str=prepare_options_query(
+                page_num=page_num,
+                per_page=per_page,
+            ),
+        )
+        for page_num in range(2, page_count + 1)
+    ])
+
+    patents = []
+    for response_dict in [first_page, *remaining_pages]:
+        # The API returns `"patents": null` for an empty window
+        patents.extend(response_dict.get('patents') or [])
+
+    return patents
+
+
+async def crawl_months(
+    client: PatentsViewClient,
+    years: Iterable[Union[str, int]],
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    profile: Optional[str] = None,
+) -> AsyncIterator[Tuple[int, int, List[dict]]]:
+    """
+    Crawls every month of `years` and yields `(year, month, patents)` as
+    soon as a month is complete, in the order the months finish
+    """
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    async def crawl_month(year, month):
+        patents = await crawl_window(
+            client=client,
+            date_query_str=prepare_date_query(year=year, month=month),
+            f_parameter_str=f_parameter_str,
+            url=url,
+            per_page=per_page,
+        )
+        return year, month, patents
+
+    tasks = [
+        asyncio.ensure_future(crawl_month(year, month))
+        for year in years
+        for month in range(1, 13)
+    ]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # Don't leave requests running if the caller stops early
+        for task in tasks:
+            task.cancel()
+
+
+async def crawl_planned_windows(
+    client: PatentsViewClient,
+    years: Iterable[Union[str, int]],
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    profile: Optional[str] = None,
+) -> AsyncIterator[Tuple[DateWindow, List[dict]]]:
+    """
+    Like `crawl_months`, but the months are first re-planned by
+    `plan_windows` so dense months are split and sparse ones merged, and
+    yields `(window, patents)`
+    """
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    planned_windows = await plan_windows(
+        client=client,
+        windows=month_windows(years),
+        target=per_page,
+        url=url,
+    )
+
+    async def crawl_planned(window):
+        patents = await crawl_window(
+            client=client,
+            date_query_str=window.to_query(),
+            f_parameter_str=f_parameter_str,
+            url=url,
+            per_page=per_page,
+        )
+        return window, patents
+
+    tasks = [
+        asyncio.ensure_future(crawl_planned(window))
+        for window, _ in planned_windows
+    ]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
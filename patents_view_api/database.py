@@ -17,33 +17,171 @@
 """
 
 
-from typing import List
-import psycopg2
-
-from sqlalchemy import create_engine
+import io
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Sequence, Union
+
+from sqlalchemy import create_engine, event
 from dotenv import load_dotenv
 from os import environ
 from sqlalchemy.orm import Session
 
 import urllib
 
+from .constants import (
+    INVENTOR_OPTIONAL_COLUMNS,
+    PATENT_OPTIONAL_COLUMNS,
+    PATENT_PARTITION_YEARS,
+    PATENT_TYPES,
+)
+from .query_cache import invalidate, inventor_cache_tags, patent_cache_tags
+
 
 load_dotenv()  # take environment variables from .env.
 
 database_host = environ.get('DB_HOST')
+database_port = int(environ.get('DB_PORT', 5432))
 database_name = environ.get('DB_NAME')
 database_username = environ.get('DB_USERNAME')
 database_password = environ.get('DB_PASSWORD')
 
+# Connections opened up front the first time the pool is used
+pool_min_size = int(environ.get('DB_POOL_MIN_SIZE', 1))
+# Connections open at the same time, including the idle ones
+pool_max_size = int(environ.get('DB_POOL_MAX_SIZE', 10))
+# Seconds to wait for a free connection before giving up
+pool_timeout = float(environ.get('DB_POOL_TIMEOUT', 30))
+# Connections older than this are replaced when checked out
+pool_recycle_seconds = int(environ.get('DB_POOL_RECYCLE', 1800))
+
 
+# The one connection pool behind both `initialize_connection` (psycopg2
+# cursors) and `initialize_sqlalchemy_connection` (ORM sessions)
 engine = create_engine(
     f'postgresql://{database_username}:'
     # Escape the password to allow special characters
     f'{urllib.parse.quote(database_password)}'
-    f'@{database_host}:5432/{database_name}'
+    f'@{database_host}:{database_port}/{database_name}',
+    pool_size=pool_max_size,
+    max_overflow=0,
+    pool_timeout=pool_timeout,
+    pool_recycle=pool_recycle_seconds,
+    # Tests the connection on checkout and replaces it if the server
+    # dropped it, instead of failing the function call
+    pool_pre_ping=True,
 )
 
 
+class PoolStats:
+    """
+    How busy the connection pool is
+
+    - `checked_out` connections are in use right now
+    - `wait_seconds` is the total time spent waiting for a connection,
+        `max_wait_seconds` the longest single wait
+    - `connects` counts the new connections opened, `invalidated` the
+        ones thrown away (e.g. failed health checks)
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checked_out = 0
+        self.connects = 0
+        self.invalidated = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record_wait(self, seconds: float):
+        with self.lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def __repr__(self) -> str:
+        return (
+            f'PoolStats(checked_out={self.checked_out}, '
+            f'checkouts={self.checkouts}, connects={self.connects}, '
+            f'invalidated={self.invalidated}, '
+            f'wait_seconds={self.wait_seconds:.3f}, '
+            f'max_wait_seconds={self.max_wait_seconds:.3f}, '
+            f'pool={engine.pool.status()!r})'
+        )
+
+
+pool_stats = PoolStats()
+pool_warmed = threading.Event()
+pool_warm_lock = threading.Lock()
+
+
+@event.listens_for(engine, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    with pool_stats.lock:
+        pool_stats.connects += 1
+
+
+@event.listens_for(engine, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with pool_stats.lock:
+        pool_stats.checkouts += 1
+        pool_stats.checked_out += 1
+
+
+@event.listens_for(engine, 'checkin')
+def on_checkin(dbapi_connection, connection_record):
+    with pool_stats.lock:
+        pool_stats.checked_out -= 1
+
+
+@event.listens_for(engine, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    with pool_stats.lock:
+        pool_stats.invalidated += 1
+
+
+def warm_pool():
+    """
+    Opens `DB_POOL_MIN_SIZE` connections and puts them back in the pool,
+    so the first calls don't all pay for the connection setup
+    """
+    if pool_warmed.is_set():
+        return
+    with pool_warm_lock:
+        if pool_warmed.is_set():
+            return
+        connections = []
+        try:
+            for _ in range(min(pool_min_size, pool_max_size)):
+                connections.append(engine.raw_connection())
+        finally:
+            for connection in connections:
+                connection.close()
+        pool_warmed.set()
+
+
+def get_pool_stats() -> PoolStats:
+    return pool_stats
+
+
+@contextmanager
+def pooled_connection() -> Iterator:
+    """
+    Checks a psycopg2 connection out of the pool, `close()` on it (done
+    on exit) hands it back instead of closing it
+    """
+    warm_pool()
+    started_at = time.perf_counter()
+    conn = engine.raw_connection()
+    pool_stats.record_wait(time.perf_counter() - started_at)
+    try:
+        yield conn
+    finally:
+        # Rolled back by the pool if it wasn't committed
+        conn.close()
+
+
 def initialize_connection(func, *args, **kwargs):
     """
     A decorator for functions that need to connect to the database
@@ -54,34 +192,43 @@ def initialize_connection(func, *args, **kwargs):
         """
         Prepares the database connection for the function
         """
-        function_call_result = None
-        conn = None
-        try:
-            if 'cur' in kwargs:
-                cur = kwargs.pop('cur', None)
-            else:
-                conn = psycopg2.connect(
-                    host="localhost",
-                    database="docker",
-                    user="docker",
-                    password="docker"
-                )
-
-                cur = conn.cursor()
+        if 'cur' in kwargs:
+            cur = kwargs.pop('cur', None)
+            return func(cur=cur, *args, **kwargs)
 
+        # Borrowed from the pool, so no connection setup per call
+        with pooled_connection() as conn:
+            cur = conn.cursor()
             function_call_result = func(cur=cur, *args, **kwargs)
 
             # Saves whatever was changed during the function call
-            if conn:
-                conn.commit()
-        finally:
-            # Close the connection to free up resources from the database
-            if conn:
-                conn.close()
+            conn.commit()
+            cur.close()
         return function_call_result
     return wrapper
 
 
+def invalidate_after_commit(tags: Callable[[List[dict]], Iterable[str]]):
+    """
+    Invalidates the query cache `tags` of the records an
+    `initialize_connection` function stored once more after it committed,
+    so a read between the write and the commit can't leave the old value
+    cached. Goes above `@initialize_connection`
+
+    A call given its own `cur` is committed by the caller, only the
+    invalidation inside the function covers it
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(records, *args, **kwargs):
+            result = func(records, *args, **kwargs)
+            if 'cur' not in kwargs:
+                invalidate(tags(records))
+            return result
+        return wrapper
+    return decorator
+
+
 def initialize_sqlalchemy_connection(func, *args, **kwargs):
     """
     A decorator for functions that need to connect to the database
@@ -96,14 +243,202 @@ def initialize_sqlalchemy_connection(func, *args, **kwargs):
             session = kwargs.pop('session', None)
             function_call_result = func(session=session, *args, **kwargs)
         else:
+            warm_pool()
             with Session(engine) as session:
+                # Checks the connection out now to time the wait for it
+                started_at = time.perf_counter()
+                session.connection()
+                pool_stats.record_wait(time.perf_counter() - started_at)
                 function_call_result = func(session=session, *args, **kwargs)
         return function_call_result
     return wrapper
 
 
+class CopyRowStream(io.TextIOBase):
+    """
+    A read-only file over rows in the `COPY ... FROM STDIN` text format
+
+    `copy_expert` reads it chunk by chunk, so the rows are serialised while
+    they are sent instead of building one big string first
+    """
+
+    def __init__(self, rows: Iterable[Sequence]):
+        self.lines = (format_copy_line(row) for row in rows)
+        self.buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def format_copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def format_copy_line(row: Sequence) -> str:
+    return '\t'.join(format_copy_value(value) for value in row) + '\n'
+
+
+def copy_into_staging(
+    cur,
+    table: str,
+    columns: List[str],
+    rows: Iterable[Sequence],
+) -> str:
+    """
+    Creates a temporary copy of `table` that is dropped on commit and
+    streams `rows` into it with `COPY FROM STDIN`
+
+    `staging_row` keeps the order of the rows, so the merge can let the
+    last row win when a key shows up more than once
+    """
+    staging_table = f'staging_{table}'
+    # A previous load in the same transaction may still have it
+    cur.execute(f'DROP TABLE IF EXISTS {staging_table}')
+    cur.execute(
+        f'''
+        CREATE TEMPORARY TABLE {staging_table} (
+            LIKE {table},
+            staging_row BIGSERIAL
+        ) ON COMMIT DROP
+        '''
+    )
+    cur.copy_expert(
+        f'COPY {staging_table} ({", ".join(columns)}) FROM STDIN',
+        CopyRowStream(rows),
+    )
+    return staging_table
+
+
+def merge_staging(
+    cur,
+    table: str,
+    staging_table: str,
+    key: Union[str, List[str]],
+    columns: List[str],
+    update: bool = True,
+    keep_existing: Iterable[str] = (),
+):
+    """
+    Upserts the staging table into `table` with a single set-based
+    `INSERT ... SELECT ... ON CONFLICT`
+
+    `key` is a column name or, for a composite key, a list of them.
+    The stored values of the `keep_existing` columns are kept where the
+    staged ones are NULL, i.e. where the fields weren't fetched
+    """
+    key_columns = [key] if isinstance(key, str) else key
+    key = ', '.join(key_columns)
+    column_list = ', '.join(columns)
+    keep_existing = set(keep_existing)
+    if update:
+        conflict_action = 'UPDATE SET ' + ', '.join(
+            f'{column} = COALESCE(EXCLUDED.{column}, {table}.{column})'
+            if column in keep_existing
+            else f'{column} = EXCLUDED.{column}'
+            for column in columns
+            if column not in key_columns
+        )
+    else:
+        conflict_action = 'NOTHING'
+
+    cur.execute(
+        f'''
+        INSERT INTO {table} ({column_list})
+        SELECT DISTINCT ON ({key}) {column_list}
+        FROM {staging_table}
+        ORDER BY {key}, staging_row DESC
+        ON CONFLICT({key})
+        DO {conflict_action}
+        '''
+    )
+
+
+PATENT_COLUMNS = [
+    'patent_id',
+    'patent_date',
+    'patent_number',
+    'patent_title',
+    'patent_type',
+    'patent_num_us_patent_citations',
+]
+INVENTOR_COLUMNS = [
+    'key_id',
+    'first_name',
+    'last_name',
+    'location_longitude',
+    'location_latitude',
+    'location_city',
+    'location_state',
+]
+MAPPING_COLUMNS = ['patent_id', 'patent_date', 'inventor_key_id']
+
+
+def patent_copy_row(patent: dict) -> tuple:
+    return (
+        patent['patent_id'],
+        # The partition key, a patent without it can't be stored
+        patent['patent_date'],
+        patent.get('patent_number') or None,
+        patent['patent_title'],
+        PATENT_TYPES.get(patent.get('patent_type')),
+        # The API sends numbers as strings, sometimes empty ones
+        patent.get('patent_num_us_patent_citations') or None,
+    )
+
+
+def inventor_copy_row(inventor: dict) -> tuple:
+    return (
+        inventor['inventor_key_id'],
+        inventor['inventor_first_name'],
+        inventor['inventor_last_name'],
+        inventor.get('inventor_longitude') or None,
+        inventor.get('inventor_latitude') or None,
+        # TODO: Change me once `location_city`/`location_state` is nullable
+        inventor['inventor_city'] or '',
+        inventor['inventor_state'] or '',
+    )
+
+
+def load_inventors(inventors: Iterable[dict], cur):
+    staging_table = copy_into_staging(
+        cur,
+        'inventors',
+        INVENTOR_COLUMNS,
+        (inventor_copy_row(inventor) for inventor in inventors),
+    )
+    merge_staging(
+        cur,
+        'inventors',
+        staging_table,
+        'key_id',
+        INVENTOR_COLUMNS,
+        keep_existing=INVENTOR_OPTIONAL_COLUMNS,
+    )
+
+
+@invalidate_after_commit(patent_cache_tags)
 @initialize_connection
-def store_patents(patents: List[dict], cur):
+def store_patents(patents: List[dict], cur, commit: bool = True):
     """
         `patents: List[dict]` suggests that `patents` is a list of dictionaries
 
@@ -130,50 +465,69 @@ def store_patents(patents: List[dict], cur):
             },
             ...
         ]
-    """
-    for patent in patents:
-        # Cleans the title to avoid SQL injection via single quotes (')
-        patent['patent_title'] = patent['patent_title'].replace("'", "''")
-        # print(patent['patent_title'])
-        cur.execute(
-            f'''
-            INSERT INTO patents (patent_id, patent_title)
-            VALUES (
-                '{patent['patent_id']}',
-                '{patent['patent_title']}'
-            )
-            ON CONFLICT(patent_id)
-            DO
-                UPDATE SET patent_title='{patent['patent_title']}'
-            '''
-        )
 
-        if 'inventors' in patent:
-            store_inventors(patent['inventors'], cur=cur)
-            for inventor in patent['inventors']:
-                cur.execute(
-                    f'''
-                    INSERT INTO inventor_patent_mapping (id, patent_id, inventor_key_id)
-                    VALUES (
-                        '{patent['patent_id']};{inventor['inventor_key_id']}',
-                        '{patent['patent_id']}',
-                        '{inventor['inventor_key_id']}'
-                    )
-                    ON CONFLICT(id)
-                    DO NOTHING
-                    '''
-                )
+    Every table is loaded with `COPY` into a temporary staging table and
+    then merged with one set-based upsert, all in the same transaction
 
+    Callable like `queries.store_patents`, so it can be handed to
+    `CrawlPipeline` as `store`. `commit` is only accepted for
+    compatibility, `initialize_connection` commits every call
+    """
+    staging_patents = copy_into_staging(
+        cur,
+        'patents',
+        PATENT_COLUMNS,
+        (patent_copy_row(patent) for patent in patents),
+    )
 
-def clean_sql_string(data: str) -> str:
-    if data:
-        return data.replace("'", "''")
-    elif data is None:  # Empty data in Python
-        return 'null'  # Empty data in SQL
+    load_inventors(
+        (
+            inventor
+            for patent in patents
+            for inventor in patent.get('inventors') or []
+        ),
+        cur=cur,
+    )
 
-    return ''
+    staging_mapping = copy_into_staging(
+        cur,
+        'inventor_patent_mapping',
+        MAPPING_COLUMNS,
+        (
+            (
+                patent['patent_id'],
+                patent['patent_date'],
+                inventor['inventor_key_id'],
+            )
+            for patent in patents
+            for inventor in patent.get('inventors') or []
+        ),
+    )
+
+    # Parents before children, the mapping references both
+    merge_staging(
+        cur,
+        'patents',
+        staging_patents,
+        # `patents` is partitioned by `patent_date`, see `models.Patent`
+        ['patent_id', 'patent_date'],
+        PATENT_COLUMNS,
+        keep_existing=PATENT_OPTIONAL_COLUMNS,
+    )
+    merge_staging(
+        cur,
+        'inventor_patent_mapping',
+        staging_mapping,
+        MAPPING_COLUMNS,
+        MAPPING_COLUMNS,
+        update=False,
+    )
+    # A no-op unless the query cache of `queries.py` is on. Invalidated
+    # again after the commit, see `invalidate_after_commit`
+    invalidate(patent_cache_tags(patents))
 
 
+@invalidate_after_commit(inventor_cache_tags)
 @initialize_connection
 def store_inventors(inventors: List[dict], cur):
     """
@@ -192,41 +546,11 @@ def store_inventors(inventors: List[dict], cur):
                 "inventor_key_id": "3286472"
             }
         ]
+
+    Loaded with `COPY` and merged like in `store_patents`
     """
-    for inventor in inventors:
-        for key in (
-            'inventor_first_name',
-            'inventor_last_name',
-            'inventor_city',
-            'inventor_state',
-            'inventor_longitude',
-            'inventor_latitude',
-        ):
-            inventor[key] = clean_sql_string(inventor[key])
-
-        # print(patent['patent_title'])
-        cur.execute(
-            f'''
-            INSERT INTO inventors (key_id, first_name, last_name, location_longitude, location_latitude, location_city, location_state)
-            VALUES (
-                '{inventor['inventor_key_id']}',
-                '{inventor['inventor_first_name']}',
-                '{inventor['inventor_last_name']}',
-                {inventor['inventor_longitude']},
-                {inventor['inventor_latitude']},
-                '{inventor['inventor_city']}',
-                '{inventor['inventor_state']}'
-            )
-            ON CONFLICT(key_id)
-            DO
-                UPDATE SET first_name='{inventor['inventor_first_name']}',
-                    last_name='{inventor['inventor_last_name']}',
-                    location_longitude={inventor['inventor_longitude']},
-                    location_latitude={inventor['inventor_latitude']},
-                    location_city='{inventor['inventor_city']}',
-                    location_state='{inventor['inventor_state']}'
-            '''
-        )
+    load_inventors(inventors, cur=cur)
+    invalidate(inventor_cache_tags(inventors))
 
 
 @initialize_connection
@@ -242,7 +566,7 @@ def init_database(cur):
     cur.execute(
         '''
         CREATE TABLE IF NOT EXISTS inventors (
-            key_id VARCHAR PRIMARY KEY,
+            key_id BIGINT PRIMARY KEY,
             first_name VARCHAR NOT NULL,
             last_name VARCHAR NOT NULL,
             location_city VARCHAR NOT NULL,
@@ -257,22 +581,29 @@ def init_database(cur):
     cur.execute(
         '''
         CREATE TABLE IF NOT EXISTS patents (
-            patent_id VARCHAR PRIMARY KEY,
-            patent_title VARCHAR NOT NULL
-        );
+            patent_id VARCHAR NOT NULL,
+            patent_date DATE NOT NULL,
+            patent_number VARCHAR,
+            patent_title VARCHAR NOT NULL,
+            patent_type SMALLINT,
+            patent_num_us_patent_citations INTEGER,
+            PRIMARY KEY(patent_id, patent_date)
+        ) PARTITION BY RANGE (patent_date);
         '''
     )
+    create_patent_partitions(cur=cur)
 
     print('Initializing `inventor_patent_mapping`')
     cur.execute(
         '''
         CREATE TABLE IF NOT EXISTS inventor_patent_mapping (
-            id VARCHAR PRIMARY KEY,
             patent_id VARCHAR NOT NULL,
-            inventor_key_id VARCHAR NOT NULL,
-            CONSTRAINT patent_id_fk
-                FOREIGN KEY(patent_id)
-                REFERENCES patents(patent_id),
+            patent_date DATE NOT NULL,
+            inventor_key_id BIGINT NOT NULL,
+            PRIMARY KEY(patent_id, patent_date, inventor_key_id),
+            CONSTRAINT patent_fk
+                FOREIGN KEY(patent_id, patent_date)
+                REFERENCES patents(patent_id, patent_date),
             CONSTRAINT inventor_key_id_fk
                 FOREIGN KEY(inventor_key_id)
                 REFERENCES inventors(key_id)
@@ -285,39 +616,27 @@ def init_database(cur):
 
 
 @initialize_connection
-def store_patent(patent: dict, cur):
+def create_patent_partitions(
+    years: Iterable[int] = PATENT_PARTITION_YEARS,
+    cur=None,
+):
     """
-        `patent: dict` suggests that `patent` is a dictionary
-
-        patent:
-        {
-            "patent_id": "4180867",
-            "patent_number": "4180867",
-            "patent_title": "Space enclosing member",
-            "patent_date": "1980-01-01",
-            "patent_type": "utility",
-            "patent_num_us_patent_citations": "5",
-            "inventors": [
-                {
-                    "inventor_first_name": "Marcus L.",
-                    "inventor_last_name": "Ridgeway, Jr.",
-                    "inventor_longitude": "-97.3002",
-                    "inventor_latitude": "31.2004",
-                    "inventor_city": "Troy",
-                    "inventor_state": "TX",
-                    "inventor_key_id": "3286472"
-                }
-            ]
-        }
+    Creates the yearly partitions of `patents` that don't exist yet
+
+    Add next years' partitions before their patents arrive, Postgres
+    refuses to create a partition for rows already in `patents_default`
     """
-    # Cleans the title to avoid SQL injection via single quotes (')
-    patent['patent_title'] = patent['patent_title'].replace("'", "''")
-    print(patent['patent_title'])
+    for year in years:
+        cur.execute(
+            f'''
+            CREATE TABLE IF NOT EXISTS patents_{int(year)}
+            PARTITION OF patents
+            FOR VALUES FROM ('{int(year)}-01-01') TO ('{int(year) + 1}-01-01');
+            '''
+        )
     cur.execute(
-        f'''
-        INSERT INTO patents (patent_id, patent_title)
-        VALUES (
-            '{patent['patent_id']}',
-            '{patent['patent_title']}');
+        '''
+        CREATE TABLE IF NOT EXISTS patents_default
+        PARTITION OF patents DEFAULT;
         '''
     )
@@ -0,0 +1,150 @@
+import json
+import time
+import asyncio
+import threading
+
+from collections import deque
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from .streaming import STREAM_CHUNK_SIZE, PatentStreamParser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Pages bigger than this are parsed a chunk at a time
+DECODE_CHUNKED_BYTES = 512 * 1024
+# How many per-page records `DecodeStats` keeps
+DECODE_LOG_SIZE = 1000
+
+
+def decode_json(body: bytes) -> Any:
+    """
+    Decodes with orjson when it is installed, the stdlib otherwise
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def timed_decode_json(body: bytes) -> Tuple[Any, float]:
+    started_at = time.perf_counter()
+    data = decode_json(body)
+    return data, time.perf_counter() - started_at
+
+
+class DecodeRecord(NamedTuple):
+    body_bytes: int
+    seconds: float
+    chunked: bool
+    # The longest the event loop was held at once
+    longest_block_seconds: float
+
+
+class DecodeStats:
+    def __init__(self, log_size: int = DECODE_LOG_SIZE):
+        self.pages = 0
+        self.seconds = 0.0
+        self.chunked_pages = 0
+        self.longest_block_seconds = 0.0
+        self.records = deque(maxlen=log_size)
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        body_bytes: int,
+        seconds: float,
+        chunked: bool,
+        longest_block_seconds: float,
+    ):
+        with self.lock:
+            self.pages += 1
+            self.seconds += seconds
+            self.chunked_pages += chunked
+            self.longest_block_seconds = max(
+                self.longest_block_seconds,
+                longest_block_seconds,
+            )
+            self.records.append(DecodeRecord(
+                body_bytes,
+                seconds,
+                chunked,
+                longest_block_seconds,
+            ))
+
+    def last(self, count: int = 10) -> List[DecodeRecord]:
+        with self.lock:
+            return list(self.records)[-count:]
+
+    def __repr__(self) -> str:
+        return (
+            f'DecodeStats(pages={self.pages}, seconds={self.seconds:.3f}, '
+            f'chunked_pages={self.chunked_pages}, '
+            f'longest_block_seconds={self.longest_block_seconds:.3f}, '
+            f'backend={"orjson" if orjson else "json"})'
+        )
+
+
+class PageDecoder:
+    """
+    Decodes API pages without stalling the event loop for long
+
+    Small pages are decoded in one call. Pages over `chunked_bytes` are
+    parsed `chunk_bytes` at a time with `streaming.PatentStreamParser`,
+    handing the loop back between chunks, so the fetchers keep servicing
+    their sockets while a big page is decoded. A thread pool wouldn't do
+    that, `json.loads`/`orjson.loads` hold the GIL for the whole call
+
+    Every page's decode time, and the longest stretch it held the loop,
+    end up in `stats`
+    """
+
+    def __init__(
+        self,
+        chunked_bytes: int = DECODE_CHUNKED_BYTES,
+        chunk_bytes: int = STREAM_CHUNK_SIZE,
+        stats: Optional[DecodeStats] = None,
+    ):
+        self.chunked_bytes = chunked_bytes
+        self.chunk_bytes = chunk_bytes
+        self.stats = stats or DecodeStats()
+
+    async def decode_chunked(self, body: bytes) -> Tuple[dict, float, float]:
+        parser = PatentStreamParser()
+        patents = []
+        seconds = 0.0
+        longest_block_seconds = 0.0
+        for start in range(0, len(body), self.chunk_bytes):
+            started_at = time.perf_counter()
+            patents.extend(parser.feed(body[start:start + self.chunk_bytes]))
+            block_seconds = time.perf_counter() - started_at
+            seconds += block_seconds
+            longest_block_seconds = max(longest_block_seconds, block_seconds)
+            await asyncio.sleep(0)
+
+        started_at = time.perf_counter()
+        patents.extend(parser.close())
+        data = dict(parser.metadata)
+        # A `"patents": null` page keeps its `None`
+        data.setdefault(parser.array_key, patents)
+        block_seconds = time.perf_counter() - started_at
+        return (
+            data,
+            seconds + block_seconds,
+            max(longest_block_seconds, block_seconds),
+        )
+
+    async def decode(self, body: bytes) -> Any:
+        chunked = len(body) > self.chunked_bytes
+        if chunked:
+            data, seconds, longest_block_seconds = await self.decode_chunked(
+                body
+            )
+        else:
+            data, seconds = timed_decode_json(body)
+            longest_block_seconds = seconds
+
+        self.stats.record(len(body), seconds, chunked, longest_block_seconds)
+        return data
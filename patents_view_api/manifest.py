@@ -0,0 +1,253 @@
+import json
+import asyncio
+import hashlib
+
+from typing import Callable, Iterable, List, Optional, Set, Tuple, Union
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+
+from .api_utils import (
+    PatentsViewClient,
+    prepare_fields_query,
+    prepare_options_query,
+)
+from .cache import normalize_param
+from .constants import PATENTS_QUERY_URL, PER_PAGE, f_parameter_str
+from .crawler import count_pages
+from .database import initialize_sqlalchemy_connection
+from .models import CrawlManifest
+from .queries import store_patents
+from .stores import require_session_store
+from .windows import month_windows
+
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def make_window_key(date_query_str: str) -> str:
+    return normalize_param(date_query_str)
+
+
+def hash_patents(patents: List[dict]) -> str:
+    return hashlib.sha256(
+        json.dumps(patents, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+@initialize_sqlalchemy_connection
+def get_window_progress(
+    window_key: str,
+    session: Session,
+) -> Tuple[Optional[int], Set[int]]:
+    """
+    Returns the `total_patent_count` seen for the window (`None` if it was
+    never fetched) and the pages that are already stored
+    """
+    rows = session.query(
+        CrawlManifest.page,
+        CrawlManifest.status,
+        CrawlManifest.total_patent_count,
+    ).where(
+        CrawlManifest.window_key == window_key
+    ).all()
+
+    total_patent_count = None
+    completed_pages = set()
+    for page, status, page_total_patent_count in rows:
+        if page_total_patent_count is not None:
+            total_patent_count = page_total_patent_count
+        if status == COMPLETED:
+            completed_pages.add(page)
+
+    return total_patent_count, completed_pages
+
+
+def upsert_manifest(session: Session, **values):
+    manifest_stmt = insert(CrawlManifest).values(**values)
+    manifest_stmt = manifest_stmt.on_conflict_do_update(
+        index_elements=[CrawlManifest.window_key, CrawlManifest.page],
+        set_={
+            **{
+                key: getattr(manifest_stmt.excluded, key)
+                for key in values
+                if key not in ('window_key', 'page')
+            },
+            'updated_at': func.now(),
+        }
+    )
+    session.execute(manifest_stmt)
+
+
+@initialize_sqlalchemy_connection
+def store_page(
+    patents: List[dict],
+    window_key: str,
+    page: int,
+    total_patent_count: int,
+    session: Session,
+    store: Callable = store_patents,
+):
+    """
+    Stores the patents of one page and marks the page as completed in the
+    same transaction, so the manifest never claims rows that aren't there
+
+    `store` must be a session store, see `stores.py`
+    """
+    require_session_store(store)
+    store(patents, session=session)
+    upsert_manifest(
+        session,
+        window_key=window_key,
+        page=page,
+        status=COMPLETED,
+        total_patent_count=total_patent_count,
+        row_count=len(patents),
+        response_hash=hash_patents(patents),
+        error=None,
+    )
+    session.commit()
+
+
+@initialize_sqlalchemy_connection
+def record_failed_page(
+    window_key: str,
+    page: int,
+    error: str,
+    session: Session,
+):
+    upsert_manifest(
+        session,
+        window_key=window_key,
+        page=page,
+        status=FAILED,
+        error=error,
+    )
+    session.commit()
+
+
+async def crawl_window_resumable(
+    client: PatentsViewClient,
+    date_query_str: str,
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    store: Callable = store_patents,
+    profile: Optional[str] = None,
+) -> int:
+    """
+    Like `crawler.crawl_window`, but every page is stored as soon as it
+    arrives and recorded in `crawl_manifest`. Pages that are already
+    completed are skipped, so a restarted crawl only fetches what is
+    missing or failed
+
+    Returns the number of patents stored by this call
+    """
+    # Before anything is fetched, `store_page` would refuse it anyway
+    require_session_store(store)
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+    window_key = make_window_key(date_query_str)
+    total_patent_count, completed_pages = await asyncio.to_thread(
+        get_window_progress,
+        window_key,
+    )
+
+    async def crawl_page(page_num: int) -> dict:
+        try:
+            response_dict = await client.get_api(
+                url=url,
+                date_query_str=date_query_str,
+                f_parameter_str=f_parameter_str,
+                options_query_str=prepare_options_query(
+                    page_num=page_num,
+                    per_page=per_page,
+                ),
+            )
+            patents = response_dict.get('patents') or []
+            await asyncio.to_thread(
+                store_page,
+                patents,
+                window_key=window_key,
+                page=page_num,
+                total_patent_count=response_dict.get('total_patent_count'),
+                store=store,
+            )
+        except Exception as error:
+            await asyncio.to_thread(
+                record_failed_page,
+                window_key,
+                page_num,
+                repr(error),
+            )
+            raise
+
+        return response_dict
+
+    stored_count = 0
+    if total_patent_count is None or 1 not in completed_pages:
+        first_page = await crawl_page(1)
+        total_patent_count = first_page.get('total_patent_count') or 0
+        stored_count += len(first_page.get('patents') or [])
+
+    missing_pages = [
+        page_num
+        for page_num in range(
+            2,
+            count_pages(total_patent_count, per_page=per_page) + 1,
+        )
+        if page_num not in completed_pages
+    ]
+    results = await asyncio.gather(
+        *[crawl_page(page_num) for page_num in missing_pages],
+        # Let the other pages finish and be recorded before giving up
+        return_exceptions=True,
+    )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+    for response_dict in results:
+        stored_count += len(response_dict.get('patents') or [])
+    return stored_count
+
+
+async def crawl_months_resumable(
+    client: PatentsViewClient,
+    years: Iterable[Union[str, int]],
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    store: Callable = store_patents,
+    profile: Optional[str] = None,
+) -> int:
+    """
+    Crawls every month of `years` with `crawl_window_resumable`
+
+    A month that fails doesn't stop the others, the first error is raised
+    once every month has finished
+    """
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    results = await asyncio.gather(
+        *[
+            crawl_window_resumable(
+                client=client,
+                date_query_str=window.to_query(),
+                f_parameter_str=f_parameter_str,
+                url=url,
+                per_page=per_page,
+                store=store,
+            )
+            for window in month_windows(years)
+        ],
+        return_exceptions=True,
+    )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+    return sum(results)
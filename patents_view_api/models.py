@@ -1,5 +1,7 @@
-from sqlalchemy import Column, VARCHAR, FLOAT, ForeignKey
+from sqlalchemy import Column, VARCHAR, FLOAT, SMALLINT, INTEGER, BIGINT, DATE, TIMESTAMP, ForeignKey
+from sqlalchemy import ForeignKeyConstraint, Index, UniqueConstraint, func
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects.postgresql import JSONB
 
 Base = declarative_base()
 # See here for more details about declaring `models`
@@ -8,8 +10,12 @@ Base = declarative_base()
 
 class Inventor(Base):
     __tablename__ = 'inventors'
+    __table_args__ = (
+        Index('ix_inventors_location', 'location_state', 'location_city'),
+    )
 
-    key_id = Column(VARCHAR, primary_key=True)
+    # The API sends it as a string of digits
+    key_id = Column(BIGINT, primary_key=True)
     first_name = Column(VARCHAR, nullable=False)
     last_name = Column(VARCHAR, nullable=False)
     location_city = Column(VARCHAR, nullable=False)
@@ -19,25 +25,134 @@ class Inventor(Base):
 
 
 class Patent(Base):
+    """
+    Range partitioned by year of `patent_date` (`patents_1976`, ...,
+    `patents_default`), so date bounded queries only read their years
+
+    Postgres wants the partition key in every unique constraint, hence the
+    `(patent_id, patent_date)` primary key, which `inventor_patent_mapping`
+    references as a whole
+    """
     __tablename__ = 'patents'
+    __table_args__ = (
+        # Lets the mapping -> patent join skip the table
+        Index(
+            'ix_patents_patent_id_covering',
+            'patent_id',
+            postgresql_include=['patent_title', 'patent_date'],
+        ),
+        {'postgresql_partition_by': 'RANGE (patent_date)'},
+    )
 
     patent_id = Column(VARCHAR, primary_key=True)
+    patent_date = Column(DATE, primary_key=True, index=True)
+    # Not always `patent_id`, and not always a number (e.g. `D254321`)
+    patent_number = Column(VARCHAR)
     patent_title = Column(VARCHAR, nullable=False)
+    # A code of `constants.PATENT_TYPES`
+    patent_type = Column(SMALLINT)
+    patent_num_us_patent_citations = Column(INTEGER)
     created_at = Column(VARCHAR)
     updated_at = Column(VARCHAR)
 
 
 class InventorPatentMapping(Base):
     __tablename__ = 'inventor_patent_mapping'
-
-    id = Column(VARCHAR, primary_key=True)
-    patent_id = Column(
-        VARCHAR,
-        ForeignKey(Patent.patent_id),
-        nullable=False,
+    __table_args__ = (
+        # The full key of the partitioned `patents`, `patent_id` alone
+        # isn't unique to Postgres
+        ForeignKeyConstraint(
+            ['patent_id', 'patent_date'],
+            [Patent.patent_id, Patent.patent_date],
+        ),
+        # Lookups by `patent_id` use the primary key
+        Index(
+            'ix_inventor_patent_mapping_inventor_key_id',
+            'inventor_key_id',
+            'patent_id',
+            'patent_date',
+        ),
     )
+
+    # Design and reissue patent ids (e.g. `D254321`, `RE30123`) aren't
+    # numbers, so `patent_id` stays a VARCHAR
+    patent_id = Column(VARCHAR, primary_key=True)
+    # Joins on it only read the partition of the patent
+    patent_date = Column(DATE, primary_key=True)
     inventor_key_id = Column(
-        VARCHAR,
+        BIGINT,
         ForeignKey(Inventor.key_id),
+        primary_key=True,
+    )
+
+
+class CrawlManifest(Base):
+    """
+    One row per (date window, page) the crawler has fetched, so a crawl
+    that died halfway can skip what it already stored
+    """
+    __tablename__ = 'crawl_manifest'
+
+    # The normalised `q` parameter of the window
+    window_key = Column(VARCHAR, primary_key=True)
+    page = Column(INTEGER, primary_key=True)
+    # `completed` or `failed`
+    status = Column(VARCHAR, nullable=False)
+    total_patent_count = Column(INTEGER)
+    row_count = Column(INTEGER)
+    response_hash = Column(VARCHAR)
+    error = Column(VARCHAR)
+    updated_at = Column(
+        TIMESTAMP,
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False,
+    )
+
+
+class CrawlWorkItem(Base):
+    """
+    A date window of the crawl that crawler processes claim with a lease,
+    see `work_queue.py`
+    """
+    __tablename__ = 'crawl_work_queue'
+    __table_args__ = (
+        UniqueConstraint('window_start', 'window_end'),
+        Index('ix_crawl_work_queue_status', 'status', 'lease_expires_at'),
+    )
+
+    id = Column(INTEGER, primary_key=True)
+    window_start = Column(DATE, nullable=False)
+    window_end = Column(DATE, nullable=False)
+    # `pending`, `leased`, `done` or `failed`
+    status = Column(VARCHAR, server_default='pending', nullable=False)
+    worker_id = Column(VARCHAR)
+    lease_expires_at = Column(TIMESTAMP)
+    attempts = Column(INTEGER, server_default='0', nullable=False)
+    # A failed window isn't claimed again before this
+    retry_after = Column(TIMESTAMP)
+    rows_fetched = Column(INTEGER)
+    error = Column(VARCHAR)
+    updated_at = Column(
+        TIMESTAMP,
+        server_default=func.now(),
+        onupdate=func.now(),
         nullable=False,
     )
+
+
+class QuarantinedRecord(Base):
+    """
+    A record that failed to store and was set aside so the rest of its
+    batch could be committed, see `commit_policy.py`
+    """
+    __tablename__ = 'quarantined_records'
+
+    id = Column(INTEGER, primary_key=True)
+    # What the record is, e.g. `patent`, and its key
+    record_type = Column(VARCHAR, nullable=False)
+    record_key = Column(VARCHAR, index=True)
+    # The record as it came from the API
+    payload = Column(JSONB, nullable=False)
+    error = Column(VARCHAR, nullable=False)
+    created_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
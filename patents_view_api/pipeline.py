@@ -0,0 +1,256 @@
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from .api_utils import (
+    PatentsViewClient,
+    prepare_api_params,
+    prepare_fields_query,
+    prepare_options_query,
+)
+from .constants import PATENTS_QUERY_URL, PER_PAGE, f_parameter_str
+from .crawler import count_pages
+from .queries import store_patents
+
+# Response bodies waiting to be parsed
+PIPELINE_MAX_BUFFERED_BYTES = 256 * 1024 ** 2
+# Parsed patents waiting to be written
+PIPELINE_MAX_BUFFERED_ROWS = 50000
+PIPELINE_WRITERS = 4
+
+
+class Budget:
+    """
+    An async semaphore counted in rows or bytes instead of items
+
+    `acquire` waits until `amount` fits under `limit`. An item bigger than
+    the whole budget is let through when nothing else is buffered, so it
+    can't block the pipeline forever
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, amount: int):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.used == 0 or self.used + amount <= self.limit
+            )
+            self.used += amount
+
+    async def release(self, amount: int):
+        async with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+class PageJob(NamedTuple):
+    date_query_str: str
+    page_num: int
+
+
+class PipelineStats:
+    def __init__(self):
+        self.pages = 0
+        self.rows = 0
+        self.bytes = 0
+        self.fetch_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.write_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed_seconds(self) -> float:
+        finished_at = self.finished_at or time.monotonic()
+        return finished_at - self.started_at
+
+    def __repr__(self) -> str:
+        return (
+            f'PipelineStats(pages={self.pages}, rows={self.rows}, '
+            f'bytes={self.bytes}, elapsed={self.elapsed_seconds:.1f}s, '
+            f'fetch={self.fetch_seconds:.1f}s, '
+            f'parse={self.parse_seconds:.1f}s, '
+            f'write={self.write_seconds:.1f}s)'
+        )
+
+
+class CrawlPipeline:
+    """
+    Crawls date windows in three overlapping stages
+
+        fetchers --(bytes budget)--> parsers --(rows budget)--> DB writers
+
+    - `client.max_concurrency` fetchers download pages. Page 1 of a window
+        tells the parser how many more pages to schedule
+    - Parsers turn bodies into lists of patents
+    - `writers` DB writers call `store` in a thread pool, so the blocking
+        SQLAlchemy calls never stall the downloads
+
+    The budgets bound how much is buffered between stages. When the writers
+    fall behind, parsing and then downloading pauses. Throughput is then
+    roughly max(fetch, write) instead of fetch + write
+    """
+
+    def __init__(
+        self,
+        client: PatentsViewClient,
+        store: Callable = store_patents,
+        writers: int = PIPELINE_WRITERS,
+        max_buffered_bytes: int = PIPELINE_MAX_BUFFERED_BYTES,
+        max_buffered_rows: int = PIPELINE_MAX_BUFFERED_ROWS,
+        f_parameter_str: str = f_parameter_str,
+        url: str = PATENTS_QUERY_URL,
+        per_page: int = PER_PAGE,
+        profile: Optional[str] = None,
+    ):
+        # `profile` names a `FIELD_PROFILES` entry to request instead of
+        # `f_parameter_str`
+        if profile is not None:
+            f_parameter_str = prepare_fields_query(profile)
+
+        self.client = client
+        self.store = store
+        self.writers = writers
+        self.f_parameter_str = f_parameter_str
+        self.url = url
+        self.per_page = per_page
+
+        self.bytes_budget = Budget(max_buffered_bytes)
+        self.rows_budget = Budget(max_buffered_rows)
+
+        self.fetch_queue = asyncio.Queue()
+        self.parse_queue = asyncio.Queue()
+        self.write_queue = asyncio.Queue()
+
+        self.stats = PipelineStats()
+        # Pages that are scheduled but not written yet
+        self.pending_pages = 0
+        self.done = asyncio.Event()
+        self.error: Optional[BaseException] = None
+
+    def schedule(self, job: PageJob):
+        self.pending_pages += 1
+        self.fetch_queue.put_nowait(job)
+
+    def page_finished(self):
+        self.pending_pages -= 1
+        if self.pending_pages == 0:
+            self.done.set()
+
+    def fail(self, error: BaseException):
+        if self.error is None:
+            self.error = error
+        self.done.set()
+
+    async def fetcher(self):
+        while True:
+            job = await self.fetch_queue.get()
+            started_at = time.monotonic()
+            # Served from `client.cache` when the page is there
+            body = await self.client.get_body(
+                url=self.url,
+                params=prepare_api_params(
+                    date_query_str=job.date_query_str,
+                    f_parameter_str=self.f_parameter_str,
+                    options_query_str=prepare_options_query(
+                        page_num=job.page_num,
+                        per_page=self.per_page,
+                    ),
+                ),
+                window_key=job.date_query_str,
+            )
+            self.stats.fetch_seconds += time.monotonic() - started_at
+
+            await self.bytes_budget.acquire(len(body))
+            self.stats.bytes += len(body)
+            await self.parse_queue.put((job, body))
+
+    async def parser(self):
+        while True:
+            job, body = await self.parse_queue.get()
+            started_at = time.monotonic()
+            # Big pages are parsed a chunk at a time, yielding to the
+            # fetchers in between
+            response_dict = await self.client.decoder.decode(body)
+            self.stats.parse_seconds += time.monotonic() - started_at
+            await self.bytes_budget.release(len(body))
+            del body
+
+            if job.page_num == 1:
+                total_patent_count = (
+                    response_dict.get('total_patent_count') or 0
+                )
+                page_count = count_pages(
+                    total_patent_count,
+                    per_page=self.per_page,
+                )
+                for page_num in range(2, page_count + 1):
+                    self.schedule(PageJob(job.date_query_str, page_num))
+
+            patents = response_dict.get('patents') or []
+            await self.rows_budget.acquire(len(patents))
+            await self.write_queue.put(patents)
+
+    async def writer(self, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while True:
+            patents = await self.write_queue.get()
+            started_at = time.monotonic()
+            if patents:
+                await loop.run_in_executor(
+                    executor,
+                    lambda: self.store(patents, commit=True),
+                )
+            self.stats.write_seconds += time.monotonic() - started_at
+            self.stats.pages += 1
+            self.stats.rows += len(patents)
+            await self.rows_budget.release(len(patents))
+            self.page_finished()
+
+    async def guard(self, stage):
+        try:
+            await stage
+        except asyncio.CancelledError:
+            raise
+        except BaseException as error:
+            self.fail(error)
+
+    async def run(self, date_query_strs: Iterable[str]) -> PipelineStats:
+        for date_query_str in date_query_strs:
+            self.schedule(PageJob(date_query_str, 1))
+        if self.pending_pages == 0:
+            return self.stats
+
+        executor = ThreadPoolExecutor(
+            max_workers=self.writers,
+            thread_name_prefix='patents-writer',
+        )
+        tasks = [
+            *[
+                asyncio.ensure_future(self.guard(self.fetcher()))
+                for _ in range(self.client.max_concurrency)
+            ],
+            asyncio.ensure_future(self.guard(self.parser())),
+            *[
+                asyncio.ensure_future(self.guard(self.writer(executor)))
+                for _ in range(self.writers)
+            ],
+        ]
+
+        try:
+            await self.done.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=True)
+            self.stats.finished_at = time.monotonic()
+
+        if self.error is not None:
+            raise self.error
+        return self.stats
@@ -1,35 +1,361 @@
+from .constants import (
+    INVENTOR_OPTIONAL_COLUMNS,
+    PATENT_OPTIONAL_COLUMNS,
+    PATENT_TYPES,
+)
 from .models import Inventor, InventorPatentMapping, Patent
-from .database import initialize_sqlalchemy_connection
+from .query_cache import (
+    cached_query,
+    invalidate,
+    inventor_cache_tags,
+    inventor_tag,
+    patent_cache_tags,
+    table_tag,
+)
+from .database import engine, initialize_sqlalchemy_connection
+from .stores import session_store
+from contextlib import nullcontext
+from datetime import date
+from sqlalchemy import and_, func
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Union
 from sqlalchemy.dialects.postgresql import insert
 
 
+@cached_query(tags=lambda: [table_tag('inventors')])
 @initialize_sqlalchemy_connection
 def count_inventors(session: Session):
     inventor_count = session.query(Inventor).count()
     return inventor_count
 
 
+@cached_query(tags=lambda inventor_key_id: [inventor_tag(inventor_key_id)])
 @initialize_sqlalchemy_connection
-def get_inventor_patents(inventor_key_id: str, session: Session):
+def get_inventor_patents(inventor_key_id: Union[int, str], session: Session):
     results = session.query(
         Inventor, Patent
     ).where(
-        Inventor.key_id == inventor_key_id
+        # Compared as integers, the API hands out the ids as strings
+        Inventor.key_id == int(inventor_key_id)
     ).join(
         InventorPatentMapping,
         InventorPatentMapping.inventor_key_id == Inventor.key_id
     ).join(
         Patent,
-        InventorPatentMapping.patent_id == Patent.patent_id
+        and_(
+            InventorPatentMapping.patent_id == Patent.patent_id,
+            # Only the patent's partition is read
+            InventorPatentMapping.patent_date == Patent.patent_date,
+        )
     ).all()
 
     return results
 
 
+# Plain columns instead of `Inventor, Patent` entities: no ORM objects to
+# build, and the patent columns come from `ix_patents_patent_id_covering`
+INVENTOR_PATENT_COLUMNS = [
+    InventorPatentMapping.inventor_key_id,
+    Inventor.first_name,
+    Inventor.last_name,
+    Inventor.location_city,
+    Inventor.location_state,
+    Patent.patent_id,
+    Patent.patent_title,
+    Patent.patent_date,
+]
+# Rows fetched per round trip by `iter_inventors_patents`
+STREAM_YIELD_PER = 1000
+
+
+def query_inventors_patents(
+    inventor_key_ids: Iterable[Union[int, str]],
+    session: Session,
+):
+    return session.query(
+        *INVENTOR_PATENT_COLUMNS
+    ).where(
+        InventorPatentMapping.inventor_key_id.in_(
+            [int(inventor_key_id) for inventor_key_id in inventor_key_ids]
+        )
+    ).join(
+        Inventor,
+        InventorPatentMapping.inventor_key_id == Inventor.key_id
+    ).join(
+        Patent,
+        and_(
+            InventorPatentMapping.patent_id == Patent.patent_id,
+            # Only the patent's partition is read
+            InventorPatentMapping.patent_date == Patent.patent_date,
+        )
+    ).order_by(
+        InventorPatentMapping.inventor_key_id,
+        Patent.patent_date,
+    )
+
+
+@cached_query(tags=lambda inventor_key_ids: [
+    inventor_tag(inventor_key_id) for inventor_key_id in inventor_key_ids
+])
 @initialize_sqlalchemy_connection
-def store_patents(patents: List[dict], session, commit=False):
+def get_inventors_patents(
+    inventor_key_ids: Sequence[Union[int, str]],
+    session: Session,
+) -> Dict[int, List[Row]]:
+    """
+    The patents of many inventors in one query, by inventor
+
+        {3286472: [Row(inventor_key_id=3286472, first_name=..., patent_id=...,
+                       patent_title=..., patent_date=...), ...], ...}
+
+    Every requested id is a key, inventors without patents map to `[]`
+    """
+    inventor_key_ids = [
+        int(inventor_key_id) for inventor_key_id in inventor_key_ids
+    ]
+    results = {inventor_key_id: [] for inventor_key_id in inventor_key_ids}
+    if not inventor_key_ids:
+        return results
+
+    for row in query_inventors_patents(inventor_key_ids, session):
+        results[row.inventor_key_id].append(row)
+    return results
+
+
+def iter_inventors_patents(
+    inventor_key_ids: Iterable[Union[int, str]],
+    yield_per: int = STREAM_YIELD_PER,
+    session: Optional[Session] = None,
+) -> Iterator[Row]:
+    """
+    Streams the rows of `get_inventors_patents` through a server-side
+    cursor, `yield_per` rows at a time, for results too big to hold
+
+    The rows come ordered by inventor, `itertools.groupby(rows,
+    key=lambda row: row.inventor_key_id)` groups them. A generator outlives
+    the decorator's session, so it opens (and closes) its own
+    """
+    inventor_key_ids = list(inventor_key_ids)
+    if not inventor_key_ids:
+        return
+
+    if session is None:
+        session_context = Session(engine)
+    else:
+        session_context = nullcontext(session)
+    with session_context as session:
+        yield from query_inventors_patents(
+            inventor_key_ids,
+            session,
+        ).execution_options(stream_results=True).yield_per(yield_per)
+
+
+@cached_query(tags=lambda: [table_tag('patents')])
+@initialize_sqlalchemy_connection
+def get_latest_patent_date(session: Session) -> Optional[date]:
+    return session.query(func.max(Patent.patent_date)).scalar()
+
+
+# Rows per multi-row INSERT statement
+STORE_CHUNK_SIZE = 1000
+
+
+def chunked(rows: List[dict], chunk_size: int) -> Iterator[List[dict]]:
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+
+class InvalidRecordError(ValueError):
+    """
+    Raised by the `prepare_*_row` functions for an API record that can't be
+    stored, e.g. one missing a required field or with a number that isn't
+    one. A bug in the code raises something else
+    """
+
+
+def get_field(record: dict, field: str):
+    try:
+        return record[field]
+    except (KeyError, TypeError) as error:
+        raise InvalidRecordError(
+            f'`{field}` is missing from {record!r}'
+        ) from error
+
+
+def parse_number(value: Optional[str], number_type=int):
+    # The API sends numbers as strings, sometimes empty ones
+    if value is None or value == '':
+        return None
+    try:
+        return number_type(value)
+    except (TypeError, ValueError) as error:
+        raise InvalidRecordError(
+            f'{value!r} is not a {number_type.__name__}'
+        ) from error
+
+
+def parse_inventor_key_id(inventor: dict) -> int:
+    key_id = parse_number(get_field(inventor, 'inventor_key_id'))
+    if key_id is None:
+        raise InvalidRecordError(f'No `inventor_key_id` in {inventor!r}')
+    return key_id
+
+
+def prepare_patent_row(patent: dict) -> dict:
+    patent_row = {
+        'patent_id': get_field(patent, 'patent_id'),
+        'patent_title': get_field(patent, 'patent_title'),
+        # The partition key, a patent without it can't be stored
+        'patent_date': get_field(patent, 'patent_date'),
+    }
+    # Only downloaded by the `full` field profile. Empty values are NULL,
+    # which the upsert doesn't store over a value (`PATENT_OPTIONAL_COLUMNS`)
+    if 'patent_number' in patent:
+        patent_row['patent_number'] = patent['patent_number'] or None
+    if 'patent_type' in patent:
+        patent_row['patent_type'] = PATENT_TYPES.get(patent['patent_type'])
+    if 'patent_num_us_patent_citations' in patent:
+        patent_row['patent_num_us_patent_citations'] = parse_number(
+            patent['patent_num_us_patent_citations'],
+        )
+    return patent_row
+
+
+def prepare_inventor_row(inventor: dict) -> dict:
+    # TODO: Change me once `location_state`` is nullable
+    inventor_state = get_field(inventor, "inventor_state")
+    if inventor_state is None:
+        inventor_state = ''
+    inventor_city = get_field(inventor, "inventor_city")
+    if inventor_city is None:
+        inventor_city = ''
+
+    inventor_row = {
+        'key_id': parse_inventor_key_id(inventor),
+        'first_name': get_field(inventor, "inventor_first_name"),
+        'last_name': get_field(inventor, "inventor_last_name"),
+        'location_city': inventor_city,
+        'location_state': inventor_state,
+    }
+    # Coordinates are only downloaded by the `full` field profile. Empty
+    # ones are NULL, which the upsert doesn't store over a value
+    # (`INVENTOR_OPTIONAL_COLUMNS`)
+    if 'inventor_longitude' in inventor:
+        inventor_row['location_longitude'] = parse_number(
+            inventor["inventor_longitude"],
+            float,
+        )
+    if 'inventor_latitude' in inventor:
+        inventor_row['location_latitude'] = parse_number(
+            inventor["inventor_latitude"],
+            float,
+        )
+    return inventor_row
+
+
+def prepare_mapping_row(patent: dict, inventor: dict) -> dict:
+    return {
+        'patent_id': get_field(patent, 'patent_id'),
+        'patent_date': get_field(patent, 'patent_date'),
+        'inventor_key_id': parse_inventor_key_id(inventor),
+    }
+
+
+def key_columns(key: Union[str, Sequence[str]]) -> List[str]:
+    # A single column or the columns of a composite key
+    return [key] if isinstance(key, str) else list(key)
+
+
+def collapse_rows(
+    rows: Iterable[dict],
+    key: Union[str, Sequence[str]],
+) -> List[dict]:
+    """
+    Merges the rows that share a `key` into one, the later rows winning
+    column by column
+
+    A prolific inventor shows up on many patents of the same page. Merging
+    them first means one upsert (one row lock, one dead tuple) per key and
+    batch instead of one per appearance. Columns missing from a later row
+    keep the earlier value, like running the upserts one after another
+    """
+    columns = key_columns(key)
+    collapsed = {}
+    for row in rows:
+        row_key = tuple(row[column] for column in columns)
+        collapsed.setdefault(row_key, {}).update(row)
+    return list(collapsed.values())
+
+
+def upsert_rows(
+    session: Session,
+    model,
+    rows: List[dict],
+    key: Union[str, Sequence[str]],
+    chunk_size: int = STORE_CHUNK_SIZE,
+    update: bool = True,
+    keep_existing: Iterable[str] = (),
+):
+    """
+    Upserts `rows` with one `INSERT ... VALUES (...), (...) ON CONFLICT`
+    per `chunk_size` rows instead of one statement per row
+
+    Duplicate keys are collapsed across the whole batch first (see
+    `collapse_rows`), Postgres also refuses to update the same row twice
+    in one statement. The rows are then written in `key` order, so
+    concurrent writers lock the rows they share in the same order instead
+    of deadlocking
+
+    `key` is a column name or, for a composite key, a list of them.
+    The stored values of the `keep_existing` columns are kept where the
+    new ones are NULL, like `database.merge_staging` does
+    """
+    index_elements = key_columns(key)
+    keep_existing = set(keep_existing)
+    # Every row of a multi-row VALUES needs the same columns
+    rows_by_columns = {}
+    for row in sorted(
+        collapse_rows(rows, key),
+        key=lambda row: tuple(row[column] for column in index_elements),
+    ):
+        rows_by_columns.setdefault(tuple(sorted(row)), []).append(row)
+
+    for columns, column_rows in rows_by_columns.items():
+        for chunk in chunked(column_rows, chunk_size):
+            stmt = insert(model).values(chunk)
+            if update:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=index_elements,
+                    set_={
+                        column: (
+                            func.coalesce(
+                                stmt.excluded[column],
+                                model.__table__.c[column],
+                            )
+                            if column in keep_existing
+                            else stmt.excluded[column]
+                        )
+                        for column in columns
+                        if column not in index_elements
+                    },
+                )
+            else:
+                stmt = stmt.on_conflict_do_nothing(
+                    index_elements=index_elements,
+                )
+            session.execute(stmt)
+
+
+@session_store
+@initialize_sqlalchemy_connection
+def store_patents(
+    patents: List[dict],
+    session,
+    commit=False,
+    chunk_size: int = STORE_CHUNK_SIZE,
+    include_inventors: bool = True,
+):
     """
         `patents: List[dict]` suggests that `patents` is a list of dictionaries
 
@@ -56,30 +382,43 @@ def store_patents(patents: List[dict], session, commit=False):
             },
             ...
         ]
+
+    Pass `include_inventors=False` when the inventors were already stored,
+    e.g. by another writer (see `writers.PartitionedWriter`)
     """
-    for patent in patents:
-        patent_stmt = insert(Patent).values(
-            patent_id=patent['patent_id'],
-            patent_title=patent['patent_title'],
-        ).on_conflict_do_update(
-            index_elements=[Patent.patent_id],
-            set_={
-                'patent_title': patent['patent_title']
-            }
-        )
-        session.execute(patent_stmt)
-
-        if 'inventors' in patent:
-            store_inventors(patent['inventors'], session=session)
-            for inventor in patent['inventors']:
-                inv_patent_stmt = insert(InventorPatentMapping).values(
-                    id=f"{patent['patent_id']};{inventor['inventor_key_id']}",
-                    patent_id=patent['patent_id'],
-                    inventor_key_id=inventor['inventor_key_id'],
-                ).on_conflict_do_nothing(
-                    index_elements=[InventorPatentMapping.id]
-                )
-                session.execute(inv_patent_stmt)
+    upsert_rows(
+        session,
+        Patent,
+        [prepare_patent_row(patent) for patent in patents],
+        # `patents` is partitioned by `patent_date`, see `models.Patent`
+        key=['patent_id', 'patent_date'],
+        chunk_size=chunk_size,
+        keep_existing=PATENT_OPTIONAL_COLUMNS,
+    )
+
+    # The mapping rows reference the inventors, store them first. Each
+    # inventor is upserted once per batch, however many patents it is on
+    if include_inventors:
+        inventors = [
+            inventor
+            for patent in patents
+            for inventor in patent.get('inventors') or []
+        ]
+        store_inventors(inventors, session=session, chunk_size=chunk_size)
+    upsert_rows(
+        session,
+        InventorPatentMapping,
+        [
+            prepare_mapping_row(patent, inventor)
+            for patent in patents
+            for inventor in patent.get('inventors') or []
+        ],
+        key=['patent_id', 'patent_date', 'inventor_key_id'],
+        chunk_size=chunk_size,
+        update=False,
+    )
+    # A no-op unless the query cache is on
+    invalidate(patent_cache_tags(patents), session=session)
 
     if commit:
         session.commit()
@@ -95,7 +434,12 @@ def clean_sql_string(data: str) -> str:
 
 
 @initialize_sqlalchemy_connection
-def store_inventors(inventors: List[dict], session, commit=False):
+def store_inventors(
+    inventors: List[dict],
+    session,
+    commit=False,
+    chunk_size: int = STORE_CHUNK_SIZE,
+):
     """
         `inventors: List[dict]` suggests that `inventors` is a list of
         dictionaries
@@ -113,34 +457,14 @@ def store_inventors(inventors: List[dict], session, commit=False):
             }
         ]
     """
-    for inventor in inventors:
-        # TODO: Change me once `location_state`` is nullable
-        inventor_state = inventor["inventor_state"]
-        if inventor_state is None:
-            inventor_state = ''
-        inventor_city = inventor["inventor_city"]
-        if inventor_city is None:
-            inventor_city = ''
-
-        inventor_stmt = insert(Inventor).values(
-            first_name=inventor["inventor_first_name"],
-            last_name=inventor["inventor_last_name"],
-            location_longitude=inventor["inventor_longitude"],
-            location_latitude=inventor["inventor_latitude"],
-            location_city=inventor_city,
-            location_state=inventor_state,
-            key_id=inventor["inventor_key_id"],
-        ).on_conflict_do_update(
-            index_elements=[Inventor.key_id],
-            set_={
-                'first_name': inventor["inventor_first_name"],
-                'last_name': inventor["inventor_last_name"],
-                'location_longitude': inventor["inventor_longitude"],
-                'location_latitude': inventor["inventor_latitude"],
-                'location_city': inventor_city,
-                'location_state': inventor_state,
-            }
-        )
-        session.execute(inventor_stmt)
+    upsert_rows(
+        session,
+        Inventor,
+        [prepare_inventor_row(inventor) for inventor in inventors],
+        key='key_id',
+        chunk_size=chunk_size,
+        keep_existing=INVENTOR_OPTIONAL_COLUMNS,
+    )
+    invalidate(inventor_cache_tags(inventors), session=session)
     if commit:
         session.commit()
@@ -0,0 +1,388 @@
+"""
+An opt-in read-through cache for the read functions of `queries.py`
+
+    enable_query_cache(ttl_seconds=300)
+    count_inventors()  # Postgres
+    count_inventors()  # cache
+    get_query_cache_stats()
+
+Entries are tagged with what they were read from, e.g. `inventor:3286472`
+or `table:inventors`. The write paths bump the version of the tags they
+touch and entries read under an older version are misses from then on.
+Pass `backend=SQLiteCacheBackend(path)` to share entries and versions
+between the processes of a host, the in-process LRU stays in front of it
+
+Calls given their own `session` skip the cache, that session may hold
+writes that aren't committed yet
+"""
+
+
+import json
+import time
+import pickle
+import sqlite3
+import functools
+import threading
+
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_TTL_SECONDS = 300
+# Expired rows are purged from the shared backend every this many writes
+SHARED_CACHE_PURGE_EVERY = 1000
+
+Versions = Dict[str, int]
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # Misses because a write invalidated the entry
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def add(self, **amounts: int):
+        with self.lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        return self.hits / lookups
+
+    def __repr__(self) -> str:
+        return (
+            f'CacheStats(hits={self.hits}, misses={self.misses}, '
+            f'stale={self.stale}, evictions={self.evictions}, '
+            f'invalidations={self.invalidations}, '
+            f'hit_ratio={self.hit_ratio})'
+        )
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    expires_at: float
+    # The versions of the entry's tags when it was read from Postgres
+    versions: Versions
+
+
+class SQLiteCacheBackend:
+    """
+    Entries and tag versions in a SQLite file, shared by every process on
+    the host that opens the same `path`
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    versions TEXT NOT NULL
+                )
+                '''
+            )
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS tag_versions (
+                    tag TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+                '''
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self.local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        row = self.connection().execute(
+            'SELECT value, expires_at, versions FROM entries WHERE key = ?',
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at, versions = row
+        return CacheEntry(
+            pickle.loads(value),
+            expires_at,
+            json.loads(versions),
+        )
+
+    def set(self, key: str, entry: CacheEntry):
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (
+                    key,
+                    pickle.dumps(entry.value),
+                    entry.expires_at,
+                    json.dumps(entry.versions),
+                ),
+            )
+            self.writes += 1
+            if self.writes % SHARED_CACHE_PURGE_EVERY == 0:
+                conn.execute(
+                    'DELETE FROM entries WHERE expires_at < ?',
+                    (time.time(),),
+                )
+
+    def get_versions(self, tags: Iterable[str]) -> Versions:
+        tags = list(tags)
+        versions = {tag: 0 for tag in tags}
+        if tags:
+            versions.update(self.connection().execute(
+                'SELECT tag, version FROM tag_versions WHERE tag IN '
+                f'({", ".join("?" * len(tags))})',
+                tags,
+            ).fetchall())
+        return versions
+
+    def bump_versions(self, tags: Iterable[str]):
+        with self.connection() as conn:
+            conn.executemany(
+                '''
+                INSERT INTO tag_versions VALUES (?, 1)
+                ON CONFLICT(tag) DO UPDATE SET version = version + 1
+                ''',
+                [(tag,) for tag in tags],
+            )
+
+    def clear(self):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM entries')
+
+
+class QueryCache:
+    """
+    An LRU of at most `max_entries` results, each kept `ttl_seconds`
+
+    Times are wall clock (`time.time()`), so they mean the same in every
+    process sharing a `backend`
+    """
+
+    def __init__(
+        self,
+        max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = QUERY_CACHE_TTL_SECONDS,
+        backend: Optional[SQLiteCacheBackend] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self.entries = OrderedDict()
+        # Only used without a backend, the backend keeps them otherwise
+        self.versions = {}
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+
+    def get_versions(self, tags: Iterable[str]) -> Versions:
+        if self.backend is not None:
+            return self.backend.get_versions(tags)
+        with self.lock:
+            return {tag: self.versions.get(tag, 0) for tag in tags}
+
+    def is_valid(
+        self,
+        entry: Optional[CacheEntry],
+        versions: Versions,
+    ) -> bool:
+        return (
+            entry is not None
+            and entry.expires_at > time.time()
+            and entry.versions == versions
+        )
+
+    def get(self, key: str, versions: Versions) -> Tuple[bool, Any]:
+        """
+        Returns `(True, value)` on a hit and `(False, None)` on a miss.
+        `versions` are the current versions of the entry's tags
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if self.is_valid(entry, versions):
+                self.entries.move_to_end(key)
+                self.stats.add(hits=1)
+                return True, entry.value
+
+        if self.backend is not None:
+            shared_entry = self.backend.get(key)
+            if self.is_valid(shared_entry, versions):
+                self.put(key, shared_entry)
+                self.stats.add(hits=1)
+                return True, shared_entry.value
+            entry = entry or shared_entry
+
+        self.stats.add(
+            misses=1,
+            stale=entry is not None and entry.versions != versions,
+        )
+        return False, None
+
+    def put(self, key: str, entry: CacheEntry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats.add(evictions=1)
+
+    def set(self, key: str, value: Any, versions: Versions):
+        """
+        Caches `value`. `versions` must be read before the query ran, so a
+        write that happened meanwhile makes the entry stale right away
+        """
+        entry = CacheEntry(value, time.time() + self.ttl_seconds, versions)
+        self.put(key, entry)
+        if self.backend is not None:
+            self.backend.set(key, entry)
+
+    def invalidate(self, tags: Iterable[str]):
+        tags = set(tags)
+        if not tags:
+            return
+        self.stats.add(invalidations=len(tags))
+        if self.backend is not None:
+            self.backend.bump_versions(tags)
+            return
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+
+# `None` until `enable_query_cache` is called, the cache is opt-in
+query_cache: Optional[QueryCache] = None
+
+
+def enable_query_cache(
+    max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+    ttl_seconds: float = QUERY_CACHE_TTL_SECONDS,
+    backend: Optional[SQLiteCacheBackend] = None,
+) -> QueryCache:
+    global query_cache
+    query_cache = QueryCache(max_entries, ttl_seconds, backend)
+    return query_cache
+
+
+def disable_query_cache():
+    global query_cache
+    query_cache = None
+
+
+def get_query_cache_stats() -> Optional[CacheStats]:
+    return query_cache.stats if query_cache is not None else None
+
+
+def inventor_tag(inventor_key_id) -> str:
+    return f'inventor:{int(inventor_key_id)}'
+
+
+def table_tag(table: str) -> str:
+    return f'table:{table}'
+
+
+def patent_cache_tags(patents: Iterable[dict]) -> Iterator[str]:
+    # Cached inventor results include the titles and dates of their
+    # patents. The inventors are usually stored along with the patents
+    yield table_tag('patents')
+    yield table_tag('inventors')
+    for patent in patents:
+        for inventor in patent.get('inventors') or []:
+            yield inventor_tag(inventor['inventor_key_id'])
+
+
+def inventor_cache_tags(inventors: Iterable[dict]) -> Iterator[str]:
+    yield table_tag('inventors')
+    for inventor in inventors:
+        yield inventor_tag(inventor['inventor_key_id'])
+
+
+def cached_query(tags: Callable[..., Iterable[str]]):
+    """
+    Caches the results of a query function while the query cache is on
+
+    `tags` gets the function's arguments (without `session`) and returns
+    the tags the result depends on
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = query_cache
+            # A caller's own session may hold uncommitted writes
+            if cache is None or 'session' in kwargs:
+                return func(*args, **kwargs)
+
+            key = f'{func.__module__}.{func.__qualname__}:{args!r}:' + repr(
+                sorted(kwargs.items())
+            )
+            versions = cache.get_versions(tags(*args, **kwargs))
+            hit, value = cache.get(key, versions)
+            if hit:
+                return value
+
+            value = func(*args, **kwargs)
+            cache.set(key, value, versions)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate(tags: Iterable[str], session: Optional[Session] = None):
+    """
+    Invalidates `tags` now and, when a `session` is given, once more
+    after it commits, so a read between the write and the commit can't
+    leave the old value cached
+    """
+    if query_cache is None:
+        return
+    tags = set(tags)
+    query_cache.invalidate(tags)
+    if session is not None:
+        session.info.setdefault('query_cache_tags', set()).update(tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_after_commit(session: Session):
+    tags = session.info.pop('query_cache_tags', None)
+    if tags and query_cache is not None:
+        query_cache.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_after_rollback(session: Session):
+    session.info.pop('query_cache_tags', None)
@@ -0,0 +1,189 @@
+import time
+import random
+import asyncio
+import threading
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+
+class PatentsViewAPIError(Exception):
+    """
+    Raised when the PatentsView API keeps failing after every retry the
+    `RetryPolicy` allowed
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class FailureBudgetExceeded(PatentsViewAPIError):
+    """
+    Raised when a single date window has used up its failure budget
+    """
+
+
+class TokenBucket:
+    """
+    A requests-per-second limiter shared by every request of a crawl
+
+    `rate` tokens are added every second up to `capacity`, and each request
+    takes one. It can be used from threads (`acquire`) and from the event
+    loop (`async_acquire`) at the same time
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError('`rate` must be greater than 0')
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        # Nobody gets a token before this time, see `pause`
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Takes a token and returns how many seconds the caller has to wait
+        before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated_at
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+            # The token is borrowed from the future when the bucket is
+            # empty, so waiting callers are served in order
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+            return max(wait, self.paused_until - now)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Stops handing out tokens for `seconds`, e.g. after the upstream
+        answered with `Retry-After`
+        """
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until,
+                time.monotonic() + seconds,
+            )
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    `Retry-After` is either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient API errors
+
+    - `max_retries` is the number of retries for a single request
+    - `failures_per_window` is the number of failures allowed across every
+        page of one date window, keyed by the `q` parameter
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        failures_per_window: int = 20,
+        retry_statuses: Tuple[int, ...] = (408, 429, 500, 502, 503, 504),
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures_per_window = failures_per_window
+        self.retry_statuses = retry_statuses
+
+        self.window_failures: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def should_retry(self, status: Optional[int]) -> bool:
+        # `None` means the request never got a response (connection error,
+        # timeout), which is always worth another try
+        return status is None or status in self.retry_statuses
+
+    def backoff(
+        self,
+        attempt: int,
+        retry_after: Optional[float] = None,
+    ) -> float:
+        delay = random.uniform(
+            0,
+            min(self.max_delay, self.base_delay * 2 ** attempt),
+        )
+        if retry_after is not None:
+            # Never come back earlier than the upstream asked us to
+            delay = max(delay, retry_after)
+        return delay
+
+    def next_delay(
+        self,
+        window_key: str,
+        attempt: int,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ) -> float:
+        """
+        Records a failure and returns how long to wait before retrying
+
+        Raises `PatentsViewAPIError` when the request is out of retries,
+        and `FailureBudgetExceeded` when its window is out of budget
+        """
+        with self.lock:
+            failures = self.window_failures.get(window_key, 0) + 1
+            self.window_failures[window_key] = failures
+
+        if failures > self.failures_per_window:
+            raise FailureBudgetExceeded(
+                f'{failures - 1} failures for window {window_key}',
+                status=status,
+            )
+        if attempt >= self.max_retries:
+            raise PatentsViewAPIError(
+                f'Giving up after {attempt + 1} attempts '
+                f'for window {window_key}',
+                status=status,
+            )
+
+        return self.backoff(attempt, retry_after=retry_after)
+
+    def reset_window(self, window_key: str):
+        with self.lock:
+            self.window_failures.pop(window_key, None)
@@ -0,0 +1,47 @@
+"""
+What the crawlers expect of the `store` they are handed
+
+Every store can be called as
+
+    store(patents, commit=True)
+
+and stores the page in its own transaction(s), committing before it
+returns (`CrawlPipeline`, `run_worker`, ...). `queries.store_patents`,
+`database.store_patents`, `writers.PartitionedWriter` and
+`commit_policy.CommitPolicy` all are.
+
+A session store can also be called as
+
+    store(patents, session=session)
+
+and then only writes into the caller's `session` and never commits, so
+the caller can commit other rows in the same transaction (see
+`manifest.store_page`). Mark those with `@session_store`
+"""
+
+
+from typing import Callable
+
+
+class StoreError(TypeError):
+    """
+    Raised when a store can't be used the way a caller needs it
+    """
+
+
+def session_store(store: Callable) -> Callable:
+    store.is_session_store = True
+    return store
+
+
+def is_session_store(store: Callable) -> bool:
+    return getattr(store, 'is_session_store', False)
+
+
+def require_session_store(store: Callable):
+    if not is_session_store(store):
+        raise StoreError(
+            "`store` isn't a session store, it commits on its own so its "
+            "rows can't share the caller's transaction. Use "
+            '`queries.store_patents` or a `CommitPolicy`'
+        )
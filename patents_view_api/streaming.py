@@ -0,0 +1,196 @@
+import json
+import codecs
+
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List
+
+# How many patents are handed to the caller at once when streaming
+STREAM_BATCH_SIZE = 500
+# How many bytes are read from the socket at once when streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_INCOMPLETE = object()
+_WHITESPACE = ' \t\n\r'
+
+
+class PatentStreamParser:
+    """
+    Incrementally parses a PatentsView response body
+
+        {"patents": [{...}, {...}, ...], "count": 10000, "total_patent_count": 12345}
+
+    `feed` takes the body chunk by chunk and returns the patents that are
+    complete so far, so only one partial patent is ever buffered instead of
+    the whole page. Every other top level key (`count`,
+    `total_patent_count`) ends up in `metadata`
+    """
+
+    def __init__(self, array_key: str = 'patents'):
+        self.array_key = array_key
+        self.decoder = json.JSONDecoder()
+        self.reset()
+
+    def reset(self):
+        # Starts over on a new body, e.g. when a broken one is re-fetched
+        self.metadata = {}
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.state = 'start'
+        self.key = None
+
+    @property
+    def is_done(self) -> bool:
+        return self.state == 'done'
+
+    def feed(self, chunk: bytes) -> List[dict]:
+        # Drop what was already parsed so the buffer stays small
+        self.buffer = (
+            self.buffer[self.position:] + self.text_decoder.decode(chunk)
+        )
+        self.position = 0
+        return self._parse(final=False)
+
+    def close(self) -> List[dict]:
+        self.buffer = (
+            self.buffer[self.position:]
+            + self.text_decoder.decode(b'', final=True)
+        )
+        self.position = 0
+        patents = self._parse(final=True)
+        if not self.is_done:
+            raise ValueError('The response body ended before the JSON did')
+        return patents
+
+    def _decode(self, final: bool):
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.position)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return _INCOMPLETE
+
+        # A number at the very end of the buffer may still have digits in
+        # the next chunk
+        if end == len(self.buffer) and not final:
+            return _INCOMPLETE
+
+        self.position = end
+        return value
+
+    def _expect(self, char: str, expected: str):
+        if char not in expected:
+            raise ValueError(
+                f'Expected one of {expected!r} at position {self.position}, '
+                f'got {char!r}'
+            )
+        self.position += 1
+
+    def _parse(self, final: bool) -> List[dict]:
+        patents = []
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in _WHITESPACE
+            ):
+                self.position += 1
+            if self.position >= len(self.buffer):
+                return patents
+
+            char = self.buffer[self.position]
+
+            if self.state == 'start':
+                self._expect(char, '{')
+                self.state = 'key'
+            elif self.state == 'key':
+                if char == '}':
+                    self.position += 1
+                    self.state = 'done'
+                    continue
+                key = self._decode(final)
+                if key is _INCOMPLETE:
+                    return patents
+                self.key = key
+                self.state = 'colon'
+            elif self.state == 'colon':
+                self._expect(char, ':')
+                self.state = 'value'
+            elif self.state == 'value':
+                if self.key == self.array_key and char == '[':
+                    self.position += 1
+                    self.state = 'item'
+                    continue
+                value = self._decode(final)
+                if value is _INCOMPLETE:
+                    return patents
+                self.metadata[self.key] = value
+                self.state = 'after_value'
+            elif self.state == 'item':
+                if char == ']':
+                    self.position += 1
+                    self.state = 'after_value'
+                    continue
+                patent = self._decode(final)
+                if patent is _INCOMPLETE:
+                    return patents
+                patents.append(patent)
+                self.state = 'after_item'
+            elif self.state == 'after_item':
+                self._expect(char, ',]')
+                self.state = 'item' if char == ',' else 'after_value'
+            elif self.state == 'after_value':
+                self._expect(char, ',}')
+                self.state = 'key' if char == ',' else 'done'
+            else:
+                raise ValueError(
+                    f'Unexpected data after the end of the response at '
+                    f'position {self.position}'
+                )
+
+
+def iter_patent_batches(
+    chunks: Iterable[bytes],
+    batch_size: int = STREAM_BATCH_SIZE,
+    parser: PatentStreamParser = None,
+) -> Iterator[List[dict]]:
+    """
+    Turns the chunks of a response body into batches of at most
+    `batch_size` patents
+    """
+    if parser is None:
+        parser = PatentStreamParser()
+
+    batch = []
+    for chunk in chunks:
+        batch.extend(parser.feed(chunk))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+
+    batch.extend(parser.close())
+    while batch:
+        yield batch[:batch_size]
+        batch = batch[batch_size:]
+
+
+async def aiter_patent_batches(
+    chunks: AsyncIterable[bytes],
+    batch_size: int = STREAM_BATCH_SIZE,
+    parser: PatentStreamParser = None,
+) -> AsyncIterator[List[dict]]:
+    """
+    The `async for` version of `iter_patent_batches`
+    """
+    if parser is None:
+        parser = PatentStreamParser()
+
+    batch = []
+    async for chunk in chunks:
+        batch.extend(parser.feed(chunk))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+
+    batch.extend(parser.close())
+    while batch:
+        yield batch[:batch_size]
+        batch = batch[batch_size:]
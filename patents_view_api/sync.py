@@ -0,0 +1,79 @@
+import asyncio
+
+from datetime import date, timedelta
+from typing import Callable, List, Optional
+
+from .api_utils import PatentsViewClient, prepare_fields_query
+from .constants import PATENTS_QUERY_URL, PER_PAGE, f_parameter_str
+from .crawler import crawl_window
+from .queries import get_latest_patent_date, store_patents
+from .windows import DateWindow
+
+# Patents are granted weekly, re-fetching the last two weeks picks up
+# late corrections of the latest batches
+SYNC_OVERLAP_DAYS = 14
+# Longest window of a single delta sync query
+SYNC_WINDOW_DAYS = 31
+
+
+def delta_windows(
+    since: date,
+    until: date,
+    window_days: int = SYNC_WINDOW_DAYS,
+) -> List[DateWindow]:
+    windows = []
+    start = since
+    while start <= until:
+        end = min(until, start + timedelta(days=window_days - 1))
+        windows.append(DateWindow(start, end))
+        start = end + timedelta(days=1)
+    return windows
+
+
+async def sync_patents(
+    client: PatentsViewClient,
+    overlap_days: int = SYNC_OVERLAP_DAYS,
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    store: Callable = store_patents,
+    profile: Optional[str] = None,
+) -> int:
+    """
+    Fetches only the patents granted after the newest `patent_date` in the
+    database (minus `overlap_days`) and upserts them
+
+    `since` overrides the high-water mark, e.g. for the very first sync of
+    an empty database. Returns the number of patents stored
+    """
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    if since is None:
+        latest_patent_date = await asyncio.to_thread(get_latest_patent_date)
+        if latest_patent_date is None:
+            raise ValueError(
+                'There are no patents with a `patent_date` yet, run a full '
+                'crawl first or pass `since`'
+            )
+        since = latest_patent_date - timedelta(days=overlap_days)
+    if until is None:
+        until = date.today()
+
+    stored_count = 0
+    for window in delta_windows(since, until):
+        patents = await crawl_window(
+            client=client,
+            date_query_str=window.to_query(),
+            f_parameter_str=f_parameter_str,
+            url=url,
+            per_page=per_page,
+        )
+        print(f'Patent registrations in {window}: {len(patents)}')
+        if patents:
+            await asyncio.to_thread(store, patents, commit=True)
+        stored_count += len(patents)
+
+    return stored_count
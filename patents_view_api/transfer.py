@@ -0,0 +1,126 @@
+import zlib
+import threading
+
+from collections import deque
+from typing import List, NamedTuple, Optional
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+
+# Brotli is only offered when we (and requests/aiohttp) can decode it
+ACCEPT_ENCODING = 'br, gzip, deflate' if brotli else 'gzip, deflate'
+# How many per-request records `TransferStats` keeps
+TRANSFER_LOG_SIZE = 1000
+
+
+class Decompressor:
+    """
+    Incrementally decodes a body sent with `Content-Encoding`
+
+    Used by `PatentsViewClient`, which turns off aiohttp's own decoding so
+    it can count the compressed bytes that actually crossed the wire
+    """
+
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = (encoding or 'identity').strip().lower()
+
+        if self.encoding in ('identity', ''):
+            self.decompressor = None
+        elif self.encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+            # Some servers send raw deflate without the zlib header
+            self.is_raw_deflate = None
+        elif self.encoding == 'br':
+            if brotli is None:
+                raise ValueError(
+                    'The response is brotli encoded but brotli is not '
+                    'installed'
+                )
+            self.decompressor = brotli.Decompressor()
+        else:
+            raise ValueError(f'Unsupported Content-Encoding {encoding!r}')
+
+    def decompress(self, chunk: bytes) -> bytes:
+        if self.decompressor is None:
+            return chunk
+        if self.encoding == 'br':
+            return self.decompressor.process(chunk)
+        if self.encoding == 'deflate' and self.is_raw_deflate is None:
+            try:
+                data = self.decompressor.decompress(chunk)
+                self.is_raw_deflate = False
+                return data
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.is_raw_deflate = True
+        return self.decompressor.decompress(chunk)
+
+    def flush(self) -> bytes:
+        if self.decompressor is None or self.encoding == 'br':
+            return b''
+        return self.decompressor.flush()
+
+
+class TransferRecord(NamedTuple):
+    url: str
+    encoding: str
+    # Bytes received from the socket (compressed)
+    wire_bytes: int
+    # Bytes of the decoded JSON body
+    body_bytes: int
+
+
+class TransferStats:
+    """
+    Bytes on the wire vs decoded body size, per request and in total
+    """
+
+    def __init__(self, log_size: int = TRANSFER_LOG_SIZE):
+        self.requests = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.records = deque(maxlen=log_size)
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        url: str,
+        encoding: Optional[str],
+        wire_bytes: int,
+        body_bytes: int,
+    ):
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+            self.records.append(TransferRecord(
+                url=url,
+                encoding=encoding or 'identity',
+                wire_bytes=wire_bytes,
+                body_bytes=body_bytes,
+            ))
+
+    @property
+    def compression_ratio(self) -> Optional[float]:
+        if not self.wire_bytes:
+            return None
+        return self.body_bytes / self.wire_bytes
+
+    def last(self, count: int = 10) -> List[TransferRecord]:
+        with self.lock:
+            return list(self.records)[-count:]
+
+    def __repr__(self) -> str:
+        return (
+            f'TransferStats(requests={self.requests}, '
+            f'wire_bytes={self.wire_bytes}, body_bytes={self.body_bytes}, '
+            f'compression_ratio={self.compression_ratio})'
+        )
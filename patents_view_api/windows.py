@@ -0,0 +1,148 @@
+import json
+import calendar
+import asyncio
+
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .api_utils import PatentsViewClient, prepare_options_query
+from .constants import PATENTS_QUERY_URL, PER_PAGE
+
+
+class DateWindow(NamedTuple):
+    """
+    An inclusive range of `patent_date`s queried as one unit
+    """
+    start: date
+    end: date
+
+    @property
+    def days(self) -> int:
+        return (self.end - self.start).days + 1
+
+    def to_query(self) -> str:
+        return prepare_window_query(self.start, self.end)
+
+    def split(self) -> Tuple['DateWindow', 'DateWindow']:
+        middle = self.start + timedelta(days=self.days // 2 - 1)
+        return (
+            DateWindow(self.start, middle),
+            DateWindow(middle + timedelta(days=1), self.end),
+        )
+
+    def __str__(self) -> str:
+        return f'{self.start.isoformat()}..{self.end.isoformat()}'
+
+
+def prepare_window_query(start: date, end: date) -> str:
+    date_query = {
+        "_and": [
+            {
+                "_gte": {
+                    "patent_date": start.isoformat()
+                }
+            },
+            {
+                "_lte": {
+                    "patent_date": end.isoformat()
+                }
+            }
+        ]
+    }
+    return json.dumps(date_query)
+
+
+def month_windows(years: Iterable[Union[str, int]]) -> List[DateWindow]:
+    windows = []
+    for year in years:
+        year = int(year)
+        for month in range(1, 13):
+            days = calendar.monthrange(year, month)[1]
+            windows.append(
+                DateWindow(date(year, month, 1), date(year, month, days))
+            )
+    return windows
+
+
+def merge_windows(
+    counted_windows: List[Tuple[DateWindow, int]],
+    target: int = PER_PAGE,
+) -> List[Tuple[DateWindow, int]]:
+    """
+    Coalesces adjacent windows while their combined count fits in `target`
+
+    e.g. twelve sparse months of 1980 with 800 patents each become one
+    range query of 9,600 patents
+    """
+    merged = []
+    for window, count in sorted(counted_windows):
+        if merged:
+            last_window, last_count = merged[-1]
+            is_adjacent = last_window.end + timedelta(days=1) == window.start
+            if is_adjacent and last_count + count <= target:
+                merged[-1] = (
+                    DateWindow(last_window.start, window.end),
+                    last_count + count,
+                )
+                continue
+        merged.append((window, count))
+    return merged
+
+
+async def count_window(
+    client: PatentsViewClient,
+    window: DateWindow,
+    url: str = PATENTS_QUERY_URL,
+) -> int:
+    """
+    Asks the API for the size of a window with the smallest possible page
+    """
+    response_dict = await client.get_api(
+        url=url,
+        date_query_str=window.to_query(),
+        f_parameter_str=json.dumps(['patent_id']),
+        options_query_str=prepare_options_query(page_num=1, per_page=1),
+    )
+    return response_dict.get('total_patent_count') or 0
+
+
+async def plan_windows(
+    client: PatentsViewClient,
+    windows: List[DateWindow],
+    target: int = PER_PAGE,
+    known_counts: Optional[Dict[DateWindow, int]] = None,
+    url: str = PATENTS_QUERY_URL,
+) -> List[Tuple[DateWindow, int]]:
+    """
+    Plans the windows of a crawl so every request returns close to one full
+    page of `target` patents
+
+    - Windows above `target` are bisected (weeks, then days) until they fit.
+        A single day above `target` is kept and paginated by the crawler
+    - Adjacent windows below `target` are merged into one range query
+
+    `known_counts` holds counts observed in earlier crawls so those windows
+    don't need to be counted again. It is updated with every new count
+    """
+    if known_counts is None:
+        known_counts = {}
+
+    async def plan(window: DateWindow) -> List[Tuple[DateWindow, int]]:
+        if window not in known_counts:
+            known_counts[window] = await count_window(client, window, url=url)
+        count = known_counts[window]
+
+        if count <= target or window.days == 1:
+            return [(window, count)]
+
+        halves = await asyncio.gather(*[
+            plan(half) for half in window.split()
+        ])
+        return [counted for half in halves for counted in half]
+
+    planned = await asyncio.gather(*[plan(window) for window in windows])
+
+    return merge_windows(
+        [counted for window_plan in planned for counted in window_plan],
+        target=target,
+    )
@@ -0,0 +1,422 @@
+"""
+A work queue of date windows in Postgres, so several crawler processes (on
+one or many hosts) can share the backfill without fetching a window twice
+
+- Windows are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`, so workers
+    never wait on each other
+- A claim is a lease. A worker that dies stops renewing it and the window
+    is handed to another worker once `lease_expires_at` has passed
+- A failed window waits `retry_after` before it's claimed again, longer
+    after every attempt, so a window that keeps failing doesn't hold up
+    the windows after it
+- Workers keep polling while windows are leased by others or backing
+    off, and only stop once every window is done or has used up its
+    `max_attempts` (expired leases count as attempts too)
+"""
+
+
+import os
+import socket
+import asyncio
+
+from datetime import timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, not_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+
+from .api_utils import PatentsViewClient, prepare_fields_query
+from .constants import PATENTS_QUERY_URL, PER_PAGE, f_parameter_str
+from .crawler import crawl_window
+from .database import initialize_sqlalchemy_connection
+from .models import CrawlWorkItem
+from .queries import store_patents
+from .windows import DateWindow
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 600
+# A window that failed this many times is left for a human to look at
+MAX_ATTEMPTS = 5
+# Seconds before a failed window is retried, doubled after every attempt
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+# Longest a worker sleeps before looking for claimable windows again
+CLAIM_POLL_SECONDS = 30
+# Shortest, for rows that were only skipped because another worker was
+# locking them
+CLAIM_POLL_MIN_SECONDS = 1
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+@initialize_sqlalchemy_connection
+def enqueue_windows(windows: Iterable[DateWindow], session: Session) -> int:
+    rows = [
+        {'window_start': window.start, 'window_end': window.end}
+        for window in windows
+    ]
+    if not rows:
+        return 0
+
+    result = session.execute(
+        insert(CrawlWorkItem).values(rows).on_conflict_do_nothing(
+            index_elements=[
+                CrawlWorkItem.window_start,
+                CrawlWorkItem.window_end,
+            ]
+        )
+    )
+    session.commit()
+    return result.rowcount
+
+
+@initialize_sqlalchemy_connection
+def claim_window(
+    worker_id: str,
+    session: Session,
+    lease_seconds: int = LEASE_SECONDS,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> Optional[Tuple[int, DateWindow]]:
+    """
+    Leases the oldest claimable window to `worker_id`
+
+    Claimable means pending, leased with an expired lease, or failed fewer
+    than `max_attempts` times and past its `retry_after`. Rows locked by
+    other workers are skipped instead of waited on
+
+    An expired lease that already used up `max_attempts` is marked failed
+    instead of being reclaimed, a window whose workers keep dying on it
+    is given up on like one that keeps failing
+    """
+    session.query(CrawlWorkItem).where(
+        CrawlWorkItem.status == LEASED,
+        CrawlWorkItem.lease_expires_at < func.now(),
+        CrawlWorkItem.attempts >= max_attempts,
+    ).update(
+        {
+            CrawlWorkItem.status: FAILED,
+            CrawlWorkItem.error: (
+                f'The lease expired on each of {max_attempts} attempts'
+            ),
+            CrawlWorkItem.lease_expires_at: None,
+            CrawlWorkItem.updated_at: func.now(),
+        },
+        synchronize_session=False,
+    )
+
+    item = session.query(CrawlWorkItem).where(
+        or_(
+            CrawlWorkItem.status == PENDING,
+            and_(
+                CrawlWorkItem.status == LEASED,
+                CrawlWorkItem.lease_expires_at < func.now(),
+            ),
+            and_(
+                CrawlWorkItem.status == FAILED,
+                CrawlWorkItem.attempts < max_attempts,
+                or_(
+                    CrawlWorkItem.retry_after.is_(None),
+                    CrawlWorkItem.retry_after < func.now(),
+                ),
+            ),
+        )
+    ).order_by(
+        CrawlWorkItem.window_start
+    ).limit(1).with_for_update(skip_locked=True).first()
+
+    if item is None:
+        session.commit()
+        return None
+
+    if item.status == LEASED:
+        print(
+            f'Reclaiming {item.window_start}..{item.window_end} '
+            f'from {item.worker_id}, its lease expired'
+        )
+    item.status = LEASED
+    item.worker_id = worker_id
+    item.lease_expires_at = func.now() + timedelta(seconds=lease_seconds)
+    item.attempts = CrawlWorkItem.attempts + 1
+    item.retry_after = None
+    item.error = None
+    item_id = item.id
+    window = DateWindow(item.window_start, item.window_end)
+    session.commit()
+
+    return item_id, window
+
+
+@initialize_sqlalchemy_connection
+def seconds_until_claimable(
+    session: Session,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> Optional[float]:
+    """
+    How long until a window that isn't finished can be claimed: 0 for a
+    pending one, the end of the lease of a leased one, `retry_after` of a
+    failed one. `None` once every window is done or failed for good
+    """
+    claimable_at = case(
+        (CrawlWorkItem.status == LEASED, CrawlWorkItem.lease_expires_at),
+        (
+            CrawlWorkItem.status == FAILED,
+            func.coalesce(CrawlWorkItem.retry_after, func.now()),
+        ),
+        else_=func.now(),
+    )
+    seconds = session.query(
+        func.extract('epoch', func.min(claimable_at) - func.now())
+    ).where(
+        CrawlWorkItem.status != DONE,
+        not_(and_(
+            CrawlWorkItem.status == FAILED,
+            CrawlWorkItem.attempts >= max_attempts,
+        )),
+    ).scalar()
+
+    if seconds is None:
+        return None
+    return max(0.0, float(seconds))
+
+
+def update_owned_item(
+    session: Session,
+    item_id: int,
+    worker_id: str,
+    **values,
+) -> bool:
+    """
+    Updates the item only while `worker_id` still holds its lease
+    """
+    updated_count = session.query(CrawlWorkItem).where(
+        CrawlWorkItem.id == item_id,
+        CrawlWorkItem.worker_id == worker_id,
+        CrawlWorkItem.status == LEASED,
+    ).update(
+        {**values, CrawlWorkItem.updated_at: func.now()},
+        synchronize_session=False,
+    )
+    session.commit()
+    return updated_count == 1
+
+
+@initialize_sqlalchemy_connection
+def renew_lease(
+    item_id: int,
+    worker_id: str,
+    session: Session,
+    lease_seconds: int = LEASE_SECONDS,
+) -> bool:
+    return update_owned_item(
+        session,
+        item_id,
+        worker_id,
+        lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+    )
+
+
+@initialize_sqlalchemy_connection
+def complete_window(
+    item_id: int,
+    worker_id: str,
+    rows_fetched: int,
+    session: Session,
+) -> bool:
+    return update_owned_item(
+        session,
+        item_id,
+        worker_id,
+        status=DONE,
+        rows_fetched=rows_fetched,
+        lease_expires_at=None,
+    )
+
+
+@initialize_sqlalchemy_connection
+def fail_window(
+    item_id: int,
+    worker_id: str,
+    error: str,
+    session: Session,
+    retry_base_seconds: int = RETRY_BASE_SECONDS,
+    retry_max_seconds: int = RETRY_MAX_SECONDS,
+) -> bool:
+    # `attempts` already counts the attempt that failed
+    backoff_seconds = func.least(
+        retry_max_seconds,
+        retry_base_seconds * func.power(2, CrawlWorkItem.attempts - 1),
+    )
+    return update_owned_item(
+        session,
+        item_id,
+        worker_id,
+        status=FAILED,
+        error=error,
+        lease_expires_at=None,
+        retry_after=func.now() + backoff_seconds * timedelta(seconds=1),
+    )
+
+
+@initialize_sqlalchemy_connection
+def get_worker_progress(session: Session) -> List[dict]:
+    """
+    Windows and rows per worker and status, e.g.
+
+        [
+            {'worker_id': 'host-1:4242', 'status': 'done', 'windows': 120,
+                'rows': 812345},
+            {'worker_id': None, 'status': 'pending', 'windows': 384,
+                'rows': 0},
+        ]
+    """
+    rows = session.query(
+        CrawlWorkItem.worker_id,
+        CrawlWorkItem.status,
+        func.count(CrawlWorkItem.id),
+        func.coalesce(func.sum(CrawlWorkItem.rows_fetched), 0),
+    ).group_by(
+        CrawlWorkItem.worker_id,
+        CrawlWorkItem.status,
+    ).order_by(
+        CrawlWorkItem.worker_id,
+        CrawlWorkItem.status,
+    ).all()
+
+    return [
+        {
+            'worker_id': worker_id,
+            'status': status,
+            'windows': windows,
+            'rows': rows_fetched,
+        }
+        for worker_id, status, windows, rows_fetched in rows
+    ]
+
+
+async def keep_lease(
+    item_id: int,
+    worker_id: str,
+    lease_seconds: int,
+):
+    # Renew well before the lease runs out
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        still_owned = await asyncio.to_thread(
+            renew_lease,
+            item_id,
+            worker_id,
+            lease_seconds=lease_seconds,
+        )
+        if not still_owned:
+            print(f'{worker_id} lost the lease of work item {item_id}')
+            return
+
+
+async def run_worker(
+    client: PatentsViewClient,
+    worker_id: Optional[str] = None,
+    lease_seconds: int = LEASE_SECONDS,
+    max_attempts: int = MAX_ATTEMPTS,
+    f_parameter_str: str = f_parameter_str,
+    url: str = PATENTS_QUERY_URL,
+    per_page: int = PER_PAGE,
+    store: Callable = store_patents,
+    poll_seconds: float = CLAIM_POLL_SECONDS,
+    profile: Optional[str] = None,
+) -> int:
+    """
+    Claims, crawls and stores windows until every window is done or has
+    failed `max_attempts` times. While the rest are leased by other
+    workers or backing off, it sleeps until the next one can be claimed
+    (at most `poll_seconds` at a time). Run it in as many processes/hosts
+    as the upstream allows
+
+    Returns the number of windows this worker completed
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    if profile is not None:
+        f_parameter_str = prepare_fields_query(profile)
+
+    completed_count = 0
+    while True:
+        claim = await asyncio.to_thread(
+            claim_window,
+            worker_id,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts,
+        )
+        if claim is None:
+            wait_seconds = await asyncio.to_thread(
+                seconds_until_claimable,
+                max_attempts=max_attempts,
+            )
+            if wait_seconds is None:
+                print(f'{worker_id}: no more windows to claim')
+                return completed_count
+
+            wait_seconds = min(
+                max(wait_seconds, CLAIM_POLL_MIN_SECONDS),
+                poll_seconds,
+            )
+            print(
+                f'{worker_id}: nothing claimable yet, checking again in '
+                f'{wait_seconds:.0f}s'
+            )
+            await asyncio.sleep(wait_seconds)
+            continue
+
+        item_id, window = claim
+        lease_task = asyncio.ensure_future(
+            keep_lease(item_id, worker_id, lease_seconds)
+        )
+        try:
+            patents = await crawl_window(
+                client=client,
+                date_query_str=window.to_query(),
+                f_parameter_str=f_parameter_str,
+                url=url,
+                per_page=per_page,
+            )
+            if patents:
+                await asyncio.to_thread(store, patents, commit=True)
+        except Exception as error:
+            recorded = await asyncio.to_thread(
+                fail_window,
+                item_id,
+                worker_id,
+                repr(error),
+            )
+            print(f'{worker_id}: {window} failed with {error!r}')
+            if not recorded:
+                print(
+                    f'{worker_id}: lost the lease of {window}, the failure '
+                    'is left to the worker that holds it'
+                )
+            continue
+        finally:
+            lease_task.cancel()
+
+        completed = await asyncio.to_thread(
+            complete_window,
+            item_id,
+            worker_id,
+            len(patents),
+        )
+        if not completed:
+            # Another worker reclaimed the window after our lease expired,
+            # it's theirs to complete
+            print(
+                f'{worker_id}: {window} stored {len(patents)} patents but '
+                'the lease was lost, not counted as done'
+            )
+            continue
+        completed_count += 1
+        print(f'{worker_id}: {window} done, {len(patents)} patents')
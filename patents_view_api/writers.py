@@ -0,0 +1,179 @@
+"""
+Writes pages of patents through several database connections at once
+
+Rows are hash partitioned by key, and every partition has exactly one
+writer thread (and one pooled connection at a time), so two writers never
+upsert the same `inventors`/`patents` row. Inside a partition the rows are
+locked in key order (see `queries.upsert_rows`), and transactions that
+still lose a deadlock or serialization check, e.g. against another crawler
+process, are retried
+
+    writer = PartitionedWriter(writers=4)
+    pipeline = CrawlPipeline(client=client, store=writer)
+"""
+
+
+import time
+import random
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from .database import engine
+from .queries import STORE_CHUNK_SIZE, store_inventors, store_patents
+
+PARTITIONED_WRITERS = 4
+# deadlock_detected, serialization_failure
+RETRYABLE_PGCODES = ('40P01', '40001')
+WRITE_MAX_RETRIES = 5
+WRITE_BASE_DELAY = 0.05
+WRITE_MAX_DELAY = 2.0
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    return (
+        isinstance(error, DBAPIError)
+        and getattr(error.orig, 'pgcode', None) in RETRYABLE_PGCODES
+    )
+
+
+def partition_of(key, partitions: int) -> int:
+    # `hash()` of a str changes between processes, crc32 doesn't
+    return zlib.crc32(str(key).encode()) % partitions
+
+
+def run_transaction(
+    work: Callable[[Session], None],
+    max_retries: int = WRITE_MAX_RETRIES,
+    base_delay: float = WRITE_BASE_DELAY,
+    max_delay: float = WRITE_MAX_DELAY,
+):
+    """
+    Runs `work` in its own session and commits, starting over on a
+    deadlock or serialization failure (up to `max_retries` times)
+    """
+    attempt = 0
+    while True:
+        try:
+            with Session(engine) as session:
+                work(session)
+                session.commit()
+            return
+        except DBAPIError as error:
+            if not is_retryable_error(error) or attempt >= max_retries:
+                raise
+            attempt += 1
+            # Full jitter, so the transactions that collided don't collide
+            # again on the retry
+            time.sleep(random.uniform(
+                0,
+                min(max_delay, base_delay * 2 ** attempt),
+            ))
+
+
+class PartitionedWriter:
+    """
+    Stores batches of patents with `writers` parallel connections
+
+    A batch is written in two phases, each a transaction per partition:
+
+    1. Inventors, partitioned by `inventor_key_id`
+    2. Patents and their mapping rows, partitioned by `patent_id`. The
+        inventors they reference are committed by then
+
+    Callable like `queries.store_patents`, so it can be handed to
+    `CrawlPipeline` or `run_worker` as `store`. Several threads can call it
+    at once, partitions are still only written by their own writer
+    """
+
+    def __init__(
+        self,
+        writers: int = PARTITIONED_WRITERS,
+        chunk_size: int = STORE_CHUNK_SIZE,
+        max_retries: int = WRITE_MAX_RETRIES,
+    ):
+        self.writers = writers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        # One single-threaded executor per partition keeps the writes to a
+        # partition in order
+        self.executors = [
+            ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f'patents-partition-{partition}',
+            )
+            for partition in range(writers)
+        ]
+
+    def partition(self, rows: List[dict], key: Callable) -> Dict[int, list]:
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(
+                partition_of(key(row), self.writers),
+                [],
+            ).append(row)
+        return partitions
+
+    def run_partitions(self, partitions: Dict[int, list], work: Callable):
+        futures = [
+            self.executors[partition].submit(
+                run_transaction,
+                lambda session, rows=rows: work(rows, session),
+                self.max_retries,
+            )
+            for partition, rows in partitions.items()
+        ]
+        # Waits for every partition, then raises the first error if any
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def store_inventors(self, inventors: List[dict], session: Session):
+        store_inventors(
+            inventors,
+            session=session,
+            chunk_size=self.chunk_size,
+        )
+
+    def store_patents(self, patents: List[dict], session: Session):
+        store_patents(
+            patents,
+            session=session,
+            chunk_size=self.chunk_size,
+            include_inventors=False,
+        )
+
+    def __call__(self, patents: List[dict], commit: bool = True):
+        # Every partition commits on its own, `commit` is only accepted
+        # for compatibility with `queries.store_patents`
+        inventors = [
+            inventor
+            for patent in patents
+            for inventor in patent.get('inventors') or []
+        ]
+        self.run_partitions(
+            self.partition(
+                inventors,
+                key=lambda inventor: inventor['inventor_key_id'],
+            ),
+            self.store_inventors,
+        )
+        self.run_partitions(
+            self.partition(patents, key=lambda patent: patent['patent_id']),
+            self.store_patents,
+        )
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+    def __enter__(self) -> 'PartitionedWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
@@ -0,0 +1,22 @@
+import asyncio
+
+from patents_view_api.api_utils import PatentsViewClient
+from patents_view_api.crawler import crawl_months
+from patents_view_api.queries import store_patents
+
+
+async def main():
+    # One pooled session for the whole crawl, with at most 8 requests in
+    # flight across every month and page
+    async with PatentsViewClient(max_concurrency=8) as client:
+        async for year, month, patents in crawl_months(
+            client=client,
+            years=range(1980, 1981),
+        ):
+            print(
+                f'Patent registrations in '
+                f'{year}-{str(month).zfill(2)}: {len(patents)}'
+            )
+            store_patents(patents, commit=True)
+
+asyncio.run(main())
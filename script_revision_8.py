@@ -0,0 +1,24 @@
+import asyncio
+
+from patents_view_api.api_utils import PatentsViewClient
+from patents_view_api.pipeline import CrawlPipeline
+from patents_view_api.windows import month_windows
+from patents_view_api.writers import PartitionedWriter
+
+
+async def main():
+    # `PartitionedWriter` is a plain (thread pool) context manager, its
+    # `close()` waits for the writer threads to finish
+    async with PatentsViewClient(max_concurrency=8) as client:
+        with PartitionedWriter(writers=4) as store:
+            # Downloads keep going while earlier pages are written to the
+            # database by the writer threads, each page split across 4
+            # connections
+            pipeline = CrawlPipeline(client=client, store=store, writers=4)
+            stats = await pipeline.run(
+                window.to_query()
+                for window in month_windows(range(1980, 1981))
+            )
+    print(stats)
+
+asyncio.run(main())
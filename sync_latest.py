@@ -0,0 +1,13 @@
+import asyncio
+
+from patents_view_api.api_utils import PatentsViewClient
+from patents_view_api.sync import sync_patents
+
+
+async def main():
+    # Only fetches the grants after the newest `patent_date` we have
+    async with PatentsViewClient() as client:
+        stored_count = await sync_patents(client=client)
+    print(f'Synced {stored_count} patents')
+
+asyncio.run(main())